@@ -0,0 +1,85 @@
+"""Microbenchmark for PCMMixer: time spent per 20 ms frame.
+
+Run from anywhere with: python bench/mixer_bench.py [frames]
+"""
+import importlib.util
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRAME_BUDGET_US = 20_000
+
+
+def load_bot():
+    # discord-bot.py is a script, not a package, and reads config.yaml from the cwd
+    os.chdir(ROOT)
+    spec = importlib.util.spec_from_file_location("pirate_bot", os.path.join(ROOT, "discord-bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ToneSource:
+    def __init__(self, frequency, frames):
+        t = np.arange(960) / 48000
+        tone = (np.sin(2 * np.pi * frequency * t) * 30000).astype(np.int16)
+        self.frame = np.repeat(tone, 2).tobytes()
+        self.frames = frames
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return self.frame
+
+    def cleanup(self):
+        pass
+
+
+def measure(mixer, frames, before_frame=None):
+    timings = []
+    for i in range(frames):
+        if before_frame:
+            before_frame(mixer, i)
+        start = time.perf_counter()
+        mixer.read()
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return timings
+
+
+def report(name, timings):
+    timings.sort()
+    mean = statistics.fmean(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<16} mean {mean:7.1f} us  p99 {p99:7.1f} us  max {timings[-1]:8.1f} us  "
+          f"budget {mean / FRAME_BUDGET_US * 100:5.2f}%  ~{int(FRAME_BUDGET_US / mean)} mixers/core")
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    bot = load_bot()
+
+    mixer = bot.PCMMixer(volume=0.5)
+    mixer.crossfade_to(ToneSource(440, frames * 10))
+    report("steady volume", measure(mixer, frames))
+
+    def wobble(m, i):
+        if i % 25 == 0:
+            m.volume = 0.2 if m.volume > 0.5 else 1.0
+    report("volume ramps", measure(mixer, frames, wobble))
+
+    mixer = bot.PCMMixer(volume=1.0, crossfade=3.0)
+    mixer.crossfade_to(ToneSource(440, frames * 10))
+
+    def crossfade(m, i):
+        if i % m.fade_frames == 0:
+            m.crossfade_to(ToneSource(330 + i % 200, frames * 10))
+    report("crossfade", measure(mixer, frames, crossfade))
+
+
+if __name__ == "__main__":
+    main()
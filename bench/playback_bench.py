@@ -0,0 +1,501 @@
+"""End-to-end playback benchmark that runs entirely offline.
+
+A local aiohttp server stands in for Icecast (a paced mount with ICY metadata plus
+status-json.xsl) and for googlevideo (plain audio files), yt-dlp is replaced by a
+stub that resolves to those files, and a fake VoiceClient pulls frames on a real
+20 ms clock the way discord.py's AudioPlayer does.
+
+Run from anywhere with:
+    python bench/playback_bench.py                  # run and print results
+    python bench/playback_bench.py --save           # also store them as the baseline
+    python bench/playback_bench.py --compare        # compare against the baseline
+    python bench/playback_bench.py --opus           # benchmark the opus_passthrough path
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from mixer_bench import ROOT, load_bot
+
+DEFAULT_BASELINE = os.path.join(ROOT, "bench", "baseline.json")
+STREAM_KBPS = 128
+ICY_METAINT = 16000
+TRACK_FREQUENCIES = (330, 440, 550, 660, 770)
+
+# Lower is better for every metric; a change beyond this fraction is flagged
+REGRESSION_THRESHOLD = 0.10
+
+
+def make_tone(path, frequency, seconds):
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-f", "lavfi",
+         "-i", f"sine=frequency={frequency}:duration={seconds}", "-ac", "2", "-b:a", f"{STREAM_KBPS}k", path],
+        check=True)
+
+
+# Local Icecast / CDN stand-in, run in its own process so its CPU isn't charged to the bot
+def serve(port, media_dir, ready):
+    from aiohttp import web
+
+    stream_data = open(os.path.join(media_dir, "stream.mp3"), "rb").read()
+    listeners = {"count": 0}
+
+    async def mount(request):
+        icy = request.headers.get("Icy-MetaData") == "1"
+        response = web.StreamResponse(headers={
+            "Content-Type": "audio/mpeg",
+            "icy-name": "Bench FM",
+            **({"icy-metaint": str(ICY_METAINT)} if icy else {}),
+        })
+        await response.prepare(request)
+        listeners["count"] += 1
+        # Paced at the nominal bitrate in 100 ms chunks, like a live source
+        chunk_size = STREAM_KBPS * 125 // 10
+        position, since_meta, song = 0, 0, 0
+        try:
+            while True:
+                chunk = stream_data[position:position + chunk_size]
+                position = (position + chunk_size) % len(stream_data)
+                if icy:
+                    out = b""
+                    while chunk:
+                        take = min(len(chunk), ICY_METAINT - since_meta)
+                        out += chunk[:take]
+                        chunk = chunk[take:]
+                        since_meta += take
+                        if since_meta == ICY_METAINT:
+                            song += 1
+                            text = f"StreamTitle='Bench Artist - Song {song}';".encode()
+                            text += b"\0" * (-len(text) % 16)
+                            out += bytes([len(text) // 16]) + text
+                            since_meta = 0
+                    chunk = out
+                await response.write(chunk)
+                await asyncio.sleep(0.1)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            listeners["count"] -= 1
+        return response
+
+    async def status(request):
+        etag = f'"{listeners["count"]}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.json_response({"icestats": {
+            "host": "127.0.0.1", "server_name": "Bench FM",
+            "artist": "Bench Artist", "title": "Song",
+            "source": {"listenurl": f"http://127.0.0.1:{port}/stream.mp3", "listeners": listeners["count"]},
+        }}, headers={"ETag": etag})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/stream.mp3", mount)
+        app.router.add_get("/status-json.xsl", status)
+        app.router.add_static("/media/", media_dir)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubExtractor:
+    """Replaces yt-dlp: every query resolves to one of the local tone files"""
+
+    def __init__(self, base_url, tracks, delay=0.0):
+        self.base_url = base_url
+        self.tracks = tracks
+        self.delay = delay
+        self.calls = 0
+
+    def info(self, index):
+        frequency, seconds = self.tracks[index % len(self.tracks)]
+        video_id = f"bench{index:06d}"
+        return {
+            "id": video_id, "title": f"Tone {frequency} Hz", "extractor_key": "Youtube",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "url": f"{self.base_url}/media/tone{frequency}.mp3",
+            "duration": seconds, "uploader": "Bench", "acodec": "mp3", "abr": STREAM_KBPS, "ext": "mp3",
+        }
+
+    def extract_info(self, query):
+        # Called on the extraction pool's worker threads, like the real _extract_info
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.info(int(query.rsplit("bench", 1)[-1]))
+
+    def iter_playlist(self, url, limit, emit, stop):
+        emit(("playlist", "Bench Playlist"))
+        for index in range(min(limit, len(self.tracks))):
+            if stop.is_set():
+                return
+            time.sleep(self.delay)
+            emit(("entry", self.info(index)))
+
+
+class FakeChannel:
+    def __init__(self, bitrate=96000):
+        self.id = 1
+        self.name = "bench"
+        self.bitrate = bitrate
+        self.members = []
+
+    async def send(self, *args, **kwargs):
+        return None
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+
+
+class FakeVoiceClient:
+    """Pulls frames on a real 20 ms clock, like discord.py's AudioPlayer, and records what is heard"""
+
+    def __init__(self, bot, guild):
+        self.bot = bot
+        self.guild = guild
+        self.channel = FakeChannel()
+        guild.voice_client = self
+        self._source = None
+        self._thread = None
+        self._end = threading.Event()
+        self._paused = False
+        self.first_audio_at = None
+        self.last_audio_at = None
+        self.audio_frames = 0
+        self.underrun_frames = 0
+        self.late_frames = 0
+        self.gaps = []
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        # Same as discord.py: swapping the source does not clean up the old one
+        self._source = value
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive() and not self._paused
+
+    def is_paused(self):
+        return self._thread is not None and self._thread.is_alive() and self._paused
+
+    def play(self, source, *, after=None):
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError("Already playing audio.")
+        self._source = source
+        self._end.clear()
+        self._thread = threading.Thread(target=self._run, args=(after,), name="fake-voice", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._end.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def _record(self, data):
+        if data in (self.bot.SILENCE_FRAME, self.bot.OPUS_SILENCE):
+            if self.first_audio_at is not None:
+                self.underrun_frames += 1
+            return
+        now = time.perf_counter()
+        if self.first_audio_at is None:
+            self.first_audio_at = now
+        elif now - self.last_audio_at > 0.03:
+            # Covers both padded silence and time with nothing playing between tracks
+            self.gaps.append((now - self.last_audio_at - 0.02) * 1000)
+        self.last_audio_at = now
+        self.audio_frames += 1
+
+    def _run(self, after):
+        next_frame = time.perf_counter()
+        error = None
+        try:
+            while not self._end.is_set():
+                if self._paused:
+                    time.sleep(0.02)
+                    next_frame = time.perf_counter()
+                    continue
+                data = self._source.read()
+                if not data:
+                    break
+                self._record(data)
+                next_frame += 0.02
+                delay = next_frame - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.late_frames += 1
+        except Exception as e:
+            error = e
+        finally:
+            self._source.cleanup()
+        if after:
+            after(error)
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeContext:
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = FakeChannel()
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return None
+
+
+def ffmpeg_cpu_seconds(bot):
+    # Cumulative CPU of the ffmpeg children that are still running (Linux only)
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    for source in list(bot.metrics.ffmpeg_sources):
+        process = getattr(source, "_process", None)
+        if not hasattr(process, "pid"):
+            continue
+        try:
+            with open(f"/proc/{process.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+async def wait_until(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+async def bench_first_audio(bot, extractor, runs, guild_base):
+    """Cold !play: resolve, spawn ffmpeg, prebuffer and hand the first frame to the voice client"""
+    samples = []
+    for run in range(runs):
+        bot.resolution_cache.entries.clear()
+        guild = FakeGuild(guild_base + run)
+        voice_client = FakeVoiceClient(bot, guild)
+        ctx = FakeContext(guild)
+        player = bot.players.get(guild.id)
+        started = time.perf_counter()
+        info = await bot.resolution_cache.resolve(f"bench{run:06d}", guild_id=guild.id)
+        player.queue.add_track(bot.Track.from_info(info))
+        await bot.play_next(ctx)
+        if await wait_until(lambda: voice_client.first_audio_at is not None, 30):
+            samples.append((voice_client.first_audio_at - started) * 1000)
+        await stop_player(bot, guild)
+    return statistics.median(samples) if samples else float("nan")
+
+
+async def bench_track_changes(bot, extractor, guild_id):
+    """Play a short playlist end to end and measure silence between tracks"""
+    bot.resolution_cache.entries.clear()
+    guild = FakeGuild(guild_id)
+    voice_client = FakeVoiceClient(bot, guild)
+    ctx = FakeContext(guild)
+    started = time.perf_counter()
+    await bot.handle_playlist(ctx, "https://www.youtube.com/playlist?list=bench")
+    total = sum(seconds for _, seconds in extractor.tracks)
+    player = bot.players.get(guild.id)
+    await wait_until(lambda: player.queue.current_track is None and not voice_client.is_playing(), total + 30)
+    elapsed = time.perf_counter() - started
+    result = {
+        "first_audio_ms": ((voice_client.first_audio_at or started) - started) * 1000,
+        "track_change_gap_ms": max(voice_client.gaps, default=0),
+        "underrun_frames": voice_client.underrun_frames,
+        "late_frames": voice_client.late_frames,
+        "playlist_wall_s": elapsed,
+    }
+    await stop_player(bot, guild)
+    return result
+
+
+async def bench_streams(bot, stream_url, streams, seconds, guild_base):
+    """Several distinct broadcasts, one listener each, to measure CPU per stream and underruns"""
+    guilds = []
+    cpu_before = os.times()
+    started = time.perf_counter()
+    for index in range(streams):
+        guild = FakeGuild(guild_base + index)
+        FakeVoiceClient(bot, guild)
+        # A distinct query string gives every listener its own hub, ffmpeg and upstream connection
+        await bot.play_icecast_stream(FakeContext(guild), f"{stream_url}?bench={index}")
+        guilds.append(guild)
+    await asyncio.sleep(seconds)
+    ffmpeg_cpu = ffmpeg_cpu_seconds(bot)
+    cpu_after = os.times()
+    wall = time.perf_counter() - started
+    bot_cpu = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+
+    first_audio = [g.voice_client.first_audio_at - started for g in guilds if g.voice_client.first_audio_at]
+    result = {
+        "stream_first_audio_ms": max(first_audio, default=float("nan")) * 1000,
+        "stream_underrun_frames": sum(g.voice_client.underrun_frames for g in guilds),
+        "cpu_per_stream_pct": (bot_cpu + ffmpeg_cpu) / wall / streams * 100,
+        "bot_cpu_per_stream_pct": bot_cpu / wall / streams * 100,
+    }
+    for guild in guilds:
+        await stop_player(bot, guild)
+    return result
+
+
+async def bench_status(bot, status_url, polls=20):
+    """Status polling as done by the presence loop, including conditional requests"""
+    bot.icecast_status_cache.clear()
+    timings = []
+    for _ in range(polls):
+        start = time.perf_counter()
+        await bot.fetch_icecast_status(status_url, max_age=0)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def bench_queue_memory(bot, extractor, tracks=2000):
+    """Bytes held per queued track, metadata only (sources are created lazily)"""
+    infos = [extractor.info(i) for i in range(tracks)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    music_queue = bot.MusicQueue()
+    for info in infos:
+        music_queue.add_track(bot.Track.from_info(info))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size / tracks
+
+
+async def stop_player(bot, guild):
+    if guild.voice_client:
+        await guild.voice_client.disconnect()
+    bot.players.remove(guild.id)
+    await asyncio.sleep(0.1)
+
+
+async def run(bot, args, base_url):
+    # Normally done by bot.run(); the after-callbacks schedule play_next on bot.loop
+    bot.bot.loop = asyncio.get_running_loop()
+    bot.http_session = bot.create_http_session()
+    try:
+        results = {}
+        results["time_to_first_audio_ms"] = await bench_first_audio(bot, bot._bench_extractor, args.runs, 1000)
+        results.update(await bench_track_changes(bot, bot._bench_extractor, 2000))
+        results.update(await bench_streams(bot, f"{base_url}/stream.mp3", args.streams, args.stream_seconds, 3000))
+        results["status_fetch_ms"] = await bench_status(bot, f"{base_url}/status-json.xsl")
+        results["bytes_per_queued_track"] = bench_queue_memory(bot, bot._bench_extractor)
+        return results
+    finally:
+        await bot.http_session.close()
+        bot.extraction_pool.shutdown()
+
+
+def settings(args):
+    return {name: value for name, value in vars(args).items() if name not in ("save", "compare")}
+
+
+def report(results, baseline=None):
+    for name, value in results.items():
+        line = f"{name:<26} {value:12.1f}"
+        if baseline and name in baseline:
+            old = baseline[name]
+            if old:
+                change = (value - old) / old
+                flag = "  regressed" if change > REGRESSION_THRESHOLD else ""
+                line += f"   baseline {old:12.1f}  {change * 100:+7.1f}%{flag}"
+            else:
+                line += f"   baseline {old:12.1f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", nargs="?", const=DEFAULT_BASELINE, help="store results as a baseline")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="compare against a baseline")
+    parser.add_argument("--opus", action="store_true", help="benchmark the opus_passthrough path")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts to take the median of")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks in the playlist run")
+    parser.add_argument("--track-seconds", type=int, default=8)
+    parser.add_argument("--streams", type=int, default=3, help="concurrent broadcasts for the CPU run")
+    parser.add_argument("--stream-seconds", type=int, default=10)
+    parser.add_argument("--extract-delay", type=float, default=0.0, help="simulated yt-dlp latency in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pirate-bench-") as media_dir:
+        tracks = [(TRACK_FREQUENCIES[i % len(TRACK_FREQUENCIES)], args.track_seconds) for i in range(args.tracks)]
+        for frequency in {frequency for frequency, _ in tracks}:
+            make_tone(os.path.join(media_dir, f"tone{frequency}.mp3"), frequency, args.track_seconds)
+        make_tone(os.path.join(media_dir, "stream.mp3"), 440, 30)
+
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(port, media_dir, ready), daemon=True)
+        server.start()
+        try:
+            if not ready.wait(10):
+                sys.exit("local server did not start")
+
+            bot = load_bot()
+            bot.opus_passthrough = args.opus
+            bot.audio_cache.directory = ""
+            bot.loudness.enabled = False
+            extractor = StubExtractor(base_url, tracks, delay=args.extract_delay)
+            bot._bench_extractor = extractor
+            bot._extract_info = extractor.extract_info
+            bot._iter_playlist = extractor.iter_playlist
+
+            results = asyncio.run(run(bot, args, base_url))
+        finally:
+            server.terminate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved["settings"] != settings(args):
+            print(f"warning: baseline was recorded with different settings: {saved['settings']}")
+        baseline = saved["results"]
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"settings": settings(args), "results": results}, f, indent=2)
+        print(f"baseline saved to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,31 @@
 import discord
-from discord import FFmpegPCMAudio, PCMVolumeTransformer
+from discord import FFmpegPCMAudio
 from discord.ext import commands
 import yaml
 import aiohttp
+from aiohttp import web
 import asyncio
 import logging
 import yt_dlp
+import numpy as np
 import json
 import os
-from collections import deque
+import signal
+import sqlite3
+import time
+import itertools
+import bisect
+import heapq
+import weakref
+import random
+import threading
+import queue
+import concurrent.futures
+import multiprocessing
+from collections import deque, OrderedDict, Counter
+from array import array
 import re
+import sys
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +45,10 @@ for key in required_keys:
 icecast_base_url = '/'.join(config["icecast_url"].split('/')[:-1])
 icecast_status_url = f"{icecast_base_url}/status-json.xsl"
 
+# The main stream followed by any additional_streams from the config
+configured_streams = [{'name': 'Main', 'url': config["icecast_url"]}]
+configured_streams += [s for s in config.get("additional_streams") or [] if s.get('url')]
+
 # YouTube-DL options - Fixed for proper streaming
 ytdl_format_options = {
     'format': 'bestaudio/best',
@@ -44,6 +64,7 @@ ytdl_format_options = {
     'no_warnings': True,
     'default_search': 'auto',
     'source_address': '0.0.0.0',
+    'socket_timeout': 15,
 }
 
 # Fixed FFmpeg options for better compatibility
@@ -52,141 +73,2959 @@ ffmpeg_options = {
     'options': '-vn -f s16le -ar 48000 -ac 2',
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+def source_before_options(start=0, local=False):
+    # The reconnect flags only exist for network inputs; seeking on the input side skips straight to the offset
+    options = '' if local else ffmpeg_options['before_options']
+    if start:
+        options = f"{options} -ss {start:.1f}".strip()
+    return options
+
+def lower_priority(pid, niceness):
+    # Set after the spawn: a preexec_fn would run Python between fork and exec in a threaded process
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, niceness)
+    except ProcessLookupError:
+        # Already exited
+        pass
+    except (AttributeError, OSError) as e:
+        logging.warning(f"Could not lower the priority of process {pid}: {e}")
+
+# Let ffmpeg produce Opus directly instead of decoding to PCM and encoding in Python
+opus_passthrough = config.get("opus_passthrough", False)
+
+# Prometheus metrics, served as plain text so no client library is needed
+class Histogram:
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        # label value -> per-bucket counts, overflow, sum, count
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=''):
+        # Called from player and reader threads as well as the event loop
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [0] * (len(self.buckets) + 3)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = {label_value: list(series) for label_value, series in self.series.items()}
+        for label_value, series in snapshot.items():
+            labels = f'{self.label}="{label_value}",' if self.label else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {series[-1]}')
+            suffix = f'{{{labels.rstrip(",")}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{suffix} {series[-1]}')
+        return lines
+
+def render_gauge(name, help_text, samples, label=None):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for label_value, value in samples:
+        lines.append(f'{name}{{{label}="{label_value}"}} {value}' if label else f'{name} {value}')
+    return lines
+
+class FrameClock:
+    # Measures how far the player thread's reads drift from the 20 ms frame period
+    def __init__(self):
+        self.last = None
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last is not None and now - self.last < 1.0:
+            metrics.frame_jitter.observe(abs(now - self.last - 0.02))
+        self.last = now
+
+class Metrics:
+    def __init__(self):
+        self.extract_latency = Histogram(
+            'pirate_extract_info_seconds', 'yt-dlp extract_info latency',
+            (0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+        self.first_frame = Histogram(
+            'pirate_ffmpeg_first_frame_seconds', 'Time from ffmpeg spawn to its first audio frame',
+            (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10), label='source')
+        self.command_to_audio = Histogram(
+            'pirate_command_to_audio_seconds', 'Time from a command to the first audible frame',
+            (0.25, 0.5, 1, 2, 3, 5, 10, 30), label='command')
+        self.frame_jitter = Histogram(
+            'pirate_frame_jitter_seconds', 'Deviation of player thread reads from the 20 ms frame period',
+            (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5))
+        self.loop_lag = Histogram(
+            'pirate_event_loop_lag_seconds', 'How late the event loop runs a scheduled callback',
+            (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5))
+        self.admission_wait = Histogram(
+            'pirate_admission_wait_seconds', 'Time queued for a free ffmpeg/stream slot',
+            (0.1, 0.5, 1, 2, 5, 10, 30), label='kind')
+        # Sources whose ffmpeg process may still be running
+        self.ffmpeg_sources = weakref.WeakSet()
+        self.runner = None
+
+    def track_ffmpeg(self, source):
+        self.ffmpeg_sources.add(source)
+
+    def live_ffmpeg(self):
+        # discord.py swaps _process for a MISSING sentinel once the source is cleaned up
+        processes = [getattr(source, '_process', None) for source in list(self.ffmpeg_sources)]
+        return sum(1 for process in processes if hasattr(process, 'poll') and process.poll() is None)
+
+    def render(self):
+        lines = []
+        for histogram in (self.extract_latency, self.first_frame, self.command_to_audio, self.frame_jitter,
+                          self.loop_lag, self.admission_wait):
+            lines += histogram.render()
+        lines += render_gauge('pirate_queue_depth', 'Tracks waiting in each guild queue',
+                              [(player.guild_id, len(player.queue.queue)) for player in list(players.players.values())],
+                              label='guild')
+        lines += render_gauge('pirate_ffmpeg_processes', 'Live ffmpeg processes', [(None, self.live_ffmpeg())])
+        lines += render_gauge('pirate_admitted_sources', 'Admitted ffmpeg processes and upstream streams',
+                              sorted(resource_governor.usage().items()), label='kind')
+        lines += render_gauge('pirate_voice_clients', 'Connected voice clients per guild',
+                              [(voice_client.guild.id, 1) for voice_client in bot.voice_clients], label='guild')
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start_server(self, host, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info(f"Metrics available at http://{host}:{port}/metrics")
+
+    async def stop_server(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics = Metrics()
+
+def format_frames(frame):
+    # Outermost call first, as in folded flame graph stacks
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return names[::-1]
+
+class LoopWatchdog:
+    def __init__(self, threshold=0.25, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop_thread = None
+        self.last_beat = 0.0
+        self.stall_stack = None
+        self.stalls = deque(maxlen=20)
+        self.worst = 0.0
+        self.task = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+            lag = now - expected
+            metrics.loop_lag.observe(max(lag, 0))
+            if lag >= self.threshold:
+                # The watchdog thread grabbed the stack while the loop was still blocked
+                stack, self.stall_stack = self.stall_stack, None
+                self.stalls.append((time.time(), lag, stack[-1] if stack else 'unknown'))
+                self.worst = max(self.worst, lag)
+                logging.warning(f"Event loop blocked for {lag * 1000:.0f} ms, running:\n"
+                                + ("".join(f"  {name}\n" for name in stack) if stack else "  (no stack captured)"))
+            else:
+                self.stall_stack = None
+
+    def _watch(self):
+        while not self.stopped.wait(self.threshold / 4):
+            if self.stall_stack is None and time.monotonic() - self.last_beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                self.stall_stack = format_frames(frame) if frame else []
+
+    def stats(self):
+        if not self.task:
+            return "disabled"
+        text = f"{len(self.stalls)} stalls over {self.threshold * 1000:.0f} ms, worst {self.worst * 1000:.0f} ms"
+        if self.stalls:
+            _, lag, where = self.stalls[-1]
+            text += f", last {lag * 1000:.0f} ms in {where}"
+        return text
+
+class CommandProfiler:
+    """Samples the event loop thread while commands run and dumps profiles of slow ones"""
+    def __init__(self, threshold=1.0, directory='profiles', interval=0.005):
+        self.threshold = threshold
+        self.directory = directory
+        self.interval = interval
+        self.loop_thread = None
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.dumped = 0
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        threading.Thread(target=self._sample, name="command-profiler", daemon=True).start()
+
+    def begin(self, ctx):
+        with self.lock:
+            self.sessions[id(ctx)] = (time.perf_counter(), Counter())
+            self.active.set()
+
+    def end(self, ctx):
+        with self.lock:
+            session = self.sessions.pop(id(ctx), None)
+            if not self.sessions:
+                self.active.clear()
+        if session is None:
+            return
+        started, samples = session
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.threshold and samples:
+            name = ctx.command.qualified_name if ctx.command else 'unknown'
+            asyncio.create_task(asyncio.to_thread(self._dump, name, elapsed, samples))
+
+    def _sample(self):
+        while True:
+            self.active.wait()
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                stack = ";".join(format_frames(frame))
+                with self.lock:
+                    for _, samples in self.sessions.values():
+                        samples[stack] += 1
+            time.sleep(self.interval)
+
+    def _dump(self, name, elapsed, samples):
+        # Folded stacks, readable by flamegraph.pl and speedscope
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{elapsed * 1000:.0f}ms.folded")
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self.dumped += 1
+        logging.info(f"!{name} took {elapsed * 1000:.0f} ms, profile written to {path}")
+
+loop_watchdog = LoopWatchdog(threshold=config.get("loop_stall_ms", 250) / 1000)
+command_profiler = (CommandProfiler(threshold=config["profile_commands_ms"] / 1000,
+                                    directory=config.get("profile_dir", "profiles"))
+                    if config.get("profile_commands_ms") else None)
+
+# Flat, lazy extraction so playlist entries can be queued as soon as they are listed
+ytdl_playlist_options = dict(ytdl_format_options, noplaylist=False, extract_flat='in_playlist', lazy_playlist=True)
+
+ytdl_profiles = {
+    'track': ytdl_format_options,
+    'playlist': ytdl_playlist_options,
+}
+
+_ytdl_local = threading.local()
+
+def _get_ytdl(profile='track'):
+    # YoutubeDL instances are not thread-safe, so every worker thread gets its own
+    ytdl = getattr(_ytdl_local, profile, None)
+    if ytdl is None:
+        ytdl = yt_dlp.YoutubeDL(ytdl_profiles[profile])
+        setattr(_ytdl_local, profile, ytdl)
+    return ytdl
+
+def _extract_info(query):
+    ytdl = _get_ytdl()
+    return ytdl.sanitize_info(ytdl.extract_info(query, download=False))
+
+def _iter_playlist(url, limit, emit, stop):
+    ytdl = _get_ytdl('playlist')
+    info = ytdl.extract_info(url, download=False, process=False)
+    for _ in range(3):
+        # Follow redirects such as watch?v=...&list=... to the playlist itself
+        if info.get('_type') not in ('url', 'url_transparent'):
+            break
+        info = ytdl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+    emit(('playlist', info.get('title') or 'Unknown Playlist'))
+    entries = info.get('entries')
+    if entries is None:
+        # Not a playlist after all, queue the single video
+        emit(('entry', ytdl.sanitize_info(info)))
+        return
+    for entry in itertools.islice(entries, limit):
+        if stop.is_set():
+            return
+        if entry:
+            emit(('entry', ytdl.sanitize_info(entry)))
+
+class ExtractionJob:
+    __slots__ = ('key', 'query', 'future', 'waiters', 'started', 'abandoned')
+
+    def __init__(self, key, query, future):
+        self.key = key
+        self.query = query
+        self.future = future
+        self.waiters = 0
+        self.started = False
+        self.abandoned = False
+
+class ExtractionPool:
+    def __init__(self, workers=4, mode='thread', timeout=30):
+        self.workers = workers
+        self.mode = mode
+        self.timeout = timeout
+        # Spare capacity lets abandoned (timed out) lookups finish without blocking new ones
+        if mode == 'process':
+            # Spawned like the audio workers, forking this threaded process can deadlock the children
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers * 2,
+                                                                   mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers * 2, thread_name_prefix='ytdl')
+        self.stream_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ytdl-playlist')
+        self.inflight = {}
+        self.pending = OrderedDict()
+        self.running = 0
+        self.completed = 0
+        self.deduplicated = 0
+        self.timeouts = 0
+
+    async def extract(self, query, *, key=None, guild_id=None, timeout=None):
+        key = key or query
+        job = self.inflight.get(key)
+        if job is None:
+            job = ExtractionJob(key, query, asyncio.get_running_loop().create_future())
+            self.inflight[key] = job
+            self.pending.setdefault(guild_id, deque()).append(job)
+            self._dispatch()
+        else:
+            # Identical request already in flight, share its result
+            self.deduplicated += 1
+
+        job.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            job.waiters -= 1
+            if job.waiters == 0 and not job.future.done():
+                self._abandon(job)
+
+    async def stream_playlist(self, url, *, limit, guild_id=None):
+        # Yields ('playlist', title) once, then ('entry', info) for each entry as it is listed
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def emit(item):
+            loop.call_soon_threadsafe(items.put_nowait, item)
+
+        def run():
+            try:
+                _iter_playlist(url, limit, emit, stop)
+            except Exception as e:
+                emit(e)
+            finally:
+                emit(done)
+
+        loop.run_in_executor(self.stream_executor, run)
+        try:
+            while True:
+                item = await asyncio.wait_for(items.get(), self.timeout)
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def _abandon(self, job):
+        # Nobody is waiting any more: drop it if queued, or release its slot if running
+        job.future.cancel()
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+        if job.started and not job.abandoned:
+            job.abandoned = True
+            self.running -= 1
+            self._dispatch()
+
+    def _next_job(self):
+        # Round-robin across guilds so one guild's burst can't starve the others
+        while self.pending:
+            guild_id, jobs = next(iter(self.pending.items()))
+            job = jobs.popleft()
+            if jobs:
+                self.pending.move_to_end(guild_id)
+            else:
+                del self.pending[guild_id]
+            if not job.future.done():
+                return job
+        return None
+
+    def _dispatch(self):
+        while self.running < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+            job.started = True
+            self.running += 1
+            future = asyncio.wrap_future(self.executor.submit(_extract_info, job.query))
+            future.add_done_callback(lambda f, job=job, started=time.perf_counter(): self._finished(job, f, started))
+
+    def _finished(self, job, future, started):
+        metrics.extract_latency.observe(time.perf_counter() - started)
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+        if job.abandoned:
+            return
+        self.running -= 1
+        self.completed += 1
+        if not job.future.done():
+            if future.exception():
+                job.future.set_exception(future.exception())
+            else:
+                job.future.set_result(future.result())
+        self._dispatch()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.stream_executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        queued = sum(len(jobs) for jobs in self.pending.values())
+        return (f"{self.running}/{self.workers} running, {queued} queued, {self.completed} done, "
+                f"{self.deduplicated} deduplicated, {self.timeouts} timed out")
+
+extraction_pool = ExtractionPool(
+    workers=config.get("extract_workers", 4),
+    mode=config.get("extract_mode", "thread"),
+    timeout=config.get("extract_timeout", 30),
+)
+
+# Fields kept from a yt-dlp info dict; the full dict with every format is far larger
+CACHED_INFO_KEYS = ('id', 'title', 'url', 'webpage_url', 'duration', 'uploader',
+                    'extractor_key', 'http_headers', 'acodec', 'abr', 'asr', 'ext')
+
+YOUTUBE_ID_RE = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})')
+STREAM_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+def normalize_query(search):
+    """Map a query or URL to a cache key, using the video ID where possible"""
+    search = search.strip()
+    match = YOUTUBE_ID_RE.search(search)
+    if match:
+        return f"youtube:{match.group(1)}"
+    if search.startswith(('http://', 'https://')):
+        return f"url:{search}"
+    return "search:" + " ".join(search.lower().split())
+
+def track_key(data):
+    # Stable per-video key shared by the audio cache and loudness analysis
+    if data.get('cached'):
+        return data.get('key')
+    if data.get('id') and data.get('extractor_key'):
+        return f"{data['extractor_key'].lower()}:{data['id']}"
+    return None
+
+def stream_url_expiry(url):
+    # googlevideo stream URLs carry their expiry as a unix timestamp
+    match = STREAM_EXPIRE_RE.search(url or '')
+    return int(match.group(1)) if match else None
+
+class CachedResolution:
+    __slots__ = ('info', 'expires_at', 'url_expires_at')
+
+    def __init__(self, info, ttl, url_margin):
+        self.info = info
+        self.expires_at = time.time() + ttl
+        self.set_url(info.get('url'), url_margin)
+
+    def set_url(self, url, url_margin):
+        self.info['url'] = url
+        expiry = stream_url_expiry(url)
+        self.url_expires_at = expiry - url_margin if expiry else None
+
+    def url_expired(self):
+        return self.url_expires_at is not None and time.time() >= self.url_expires_at
+
+class ResolutionCache:
+    def __init__(self, max_entries=512, ttl=6 * 3600, url_margin=300):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.url_margin = url_margin
+        self.hits = 0
+        self.misses = 0
+        self.url_refreshes = 0
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry.expires_at:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def store(self, keys, info):
+        entry = CachedResolution(info, self.ttl, self.url_margin)
+        for key in keys:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    async def resolve(self, search, *, guild_id=None):
+        key = normalize_query(search)
+
+        entry = self.lookup(key)
+        if entry is not None:
+            self.hits += 1
+            if not entry.url_expired():
+                return entry.info
+            try:
+                await self._refresh_url(entry, guild_id)
+                return entry.info
+            except Exception as e:
+                logging.warning(f"Stream URL refresh failed for {key}, re-resolving: {e}")
+                self.invalidate(key)
+        else:
+            self.misses += 1
+
+        data = await extraction_pool.extract(search, key=key, guild_id=guild_id)
+        if 'entries' in data:
+            # Take first item from a playlist or search result
+            data = data['entries'][0]
+
+        info = {k: data.get(k) for k in CACHED_INFO_KEYS}
+        keys = [key]
+        if info['id'] and info['extractor_key']:
+            keys.append(f"{info['extractor_key'].lower()}:{info['id']}")
+        return self.store(keys, info).info
+
+    async def _refresh_url(self, entry, guild_id):
+        # Only the stream URL expires, so keep the metadata and swap the URL in place
+        page_url = entry.info.get('webpage_url')
+        data = await extraction_pool.extract(page_url, guild_id=guild_id)
+        entry.set_url(data['url'], self.url_margin)
+        self.url_refreshes += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return (f"{self.hits} hits / {self.misses} misses ({hit_rate:.0f}% hit rate), "
+                f"{self.url_refreshes} URL refreshes, {len(self.entries)} keys")
+
+resolution_cache = ResolutionCache(
+    max_entries=config.get("resolve_cache_size", 512),
+    ttl=config.get("resolve_cache_ttl", 6 * 3600),
+)
+
+# Admission priorities, lower is served first
+PRIORITY_PLAYBACK = 0  # Audio someone is about to hear
+PRIORITY_STANDBY = 1  # Failover standby connections
+PRIORITY_BACKGROUND = 2  # Prefetch, cache fills and health probes
+
+class AdmissionTimeout(Exception):
+    pass
+
+class ResourcePermit:
+    """One admitted ffmpeg process or upstream connection; released when its source is cleaned up"""
+    __slots__ = ('governor', 'guild_id', 'kind', 'released')
+
+    def __init__(self, governor, guild_id, kind):
+        self.governor = governor
+        self.guild_id = guild_id
+        self.kind = kind
+        self.released = False
+
+    def release(self):
+        self.governor._release(self)
+
+class ResourceGovernor:
+    def __init__(self, max_sources, max_guild_sources, timeout=30, background_share=0.75):
+        self.max_sources = max_sources
+        self.max_guild_sources = max_guild_sources
+        self.timeout = timeout
+        # Background work never takes the last slots, so playback can start without waiting for it
+        self.background_limit = max(1, int(max_sources * background_share))
+        # Sources are cleaned up on player threads, so the counters are guarded by a plain lock
+        self.lock = threading.Lock()
+        self.used = 0
+        self.in_use = Counter()
+        self.guild_use = Counter()
+        # (priority, seq, guild_id, kind, future, loop), most urgent first
+        self.waiters = []
+        self.seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.timeouts = 0
+
+    def _fits(self, guild_id, priority):
+        limit = self.max_sources if priority <= PRIORITY_STANDBY else self.background_limit
+        if self.used >= limit:
+            return False
+        return guild_id is None or self.guild_use[guild_id] < self.max_guild_sources
+
+    def _grant(self, guild_id, kind):
+        self.used += 1
+        self.in_use[kind] += 1
+        if guild_id is not None:
+            self.guild_use[guild_id] += 1
+        self.admitted += 1
+        return ResourcePermit(self, guild_id, kind)
+
+    def try_acquire(self, guild_id, kind, priority=PRIORITY_PLAYBACK):
+        with self.lock:
+            return self._grant(guild_id, kind) if self._fits(guild_id, priority) else None
+
+    def acquire_now(self, guild_id, kind):
+        # For swaps that free an equal resource right after, e.g. moving listeners to another hub
+        with self.lock:
+            return self._grant(guild_id, kind)
+
+    async def acquire(self, guild_id, kind, priority=PRIORITY_PLAYBACK, *, on_queued=None, timeout=None):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            # Waiters are granted as soon as they fit, so anything still queued can't fit either
+            if self._fits(guild_id, priority):
+                return self._grant(guild_id, kind)
+            future = loop.create_future()
+            heapq.heappush(self.waiters, (priority, next(self.seq), guild_id, kind, future, loop))
+            position = sum(1 for waiter in self.waiters if waiter[0] <= priority and not waiter[4].done())
+            self.queued += 1
+        logging.info(f"Queued {kind} for guild {guild_id}: {self.used}/{self.max_sources} slots in use, "
+                     f"position {position}")
+        started = time.perf_counter()
+        if on_queued:
+            try:
+                await on_queued(position)
+            except Exception as e:
+                logging.warning(f"Could not report queued {kind}: {e}")
+        try:
+            permit = await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise AdmissionTimeout(f"no free slot for {kind} after {timeout or self.timeout:.0f}s") from None
+        metrics.admission_wait.observe(time.perf_counter() - started, kind)
+        return permit
+
+    def _deliver(self, future, permit):
+        if future.done():
+            # The waiter gave up in the meantime
+            permit.release()
+        else:
+            future.set_result(permit)
+
+    def _release(self, permit):
+        with self.lock:
+            if permit.released:
+                return
+            permit.released = True
+            self.used -= 1
+            self.in_use[permit.kind] -= 1
+            if permit.guild_id is not None:
+                self.guild_use[permit.guild_id] -= 1
+                if not self.guild_use[permit.guild_id]:
+                    del self.guild_use[permit.guild_id]
+            # Hand the freed slot to the most urgent waiters that fit their budgets
+            blocked = []
+            while self.waiters:
+                waiter = heapq.heappop(self.waiters)
+                priority, _, guild_id, kind, future, loop = waiter
+                if future.done():
+                    continue
+                if self._fits(guild_id, priority):
+                    loop.call_soon_threadsafe(self._deliver, future, self._grant(guild_id, kind))
+                else:
+                    blocked.append(waiter)
+            for waiter in blocked:
+                heapq.heappush(self.waiters, waiter)
+
+    def usage(self):
+        with self.lock:
+            return dict(self.in_use)
+
+    def stats(self, guild_id=None):
+        with self.lock:
+            kinds = ", ".join(f"{kind} {count}" for kind, count in sorted(self.in_use.items()) if count)
+            waiting = sum(1 for waiter in self.waiters if not waiter[4].done())
+            text = (f"{self.used}/{self.max_sources} slots ({kinds or 'idle'}), {waiting} waiting, "
+                    f"{self.queued} queued so far, {self.timeouts} timed out")
+            if guild_id is not None:
+                text += f", this server {self.guild_use[guild_id]}/{self.max_guild_sources}"
+        return text
+
+resource_governor = ResourceGovernor(
+    config.get("max_sources", 32),
+    config.get("max_guild_sources", 3),
+    timeout=config.get("admission_timeout", 30),
+)
+
+class AudioCache:
+    def __init__(self, directory, max_bytes, min_plays=3, bitrate=128):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.bitrate = bitrate
+        # key -> metadata of a finished Ogg Opus file, least recently played first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.filling = set()
+        self.fill_lock = asyncio.Lock()
+        self.hits = 0
+        self.fills = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, re.sub(r'[^\w-]', '_', key) + ext)
+
+    def load(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                # Left behind by an interrupted fill
+                os.remove(path)
+                continue
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+                audio_stat = os.stat(meta['url'])
+                found.append((audio_stat.st_mtime, meta, audio_stat.st_size))
+            except (OSError, ValueError, KeyError):
+                os.remove(path)
+        for _, meta, size in sorted(found, key=lambda item: item[0]):
+            meta['filesize'] = size
+            self.entries[meta['key']] = meta
+            self.total_bytes += size
+        self._evict()
+        logging.info(f"Audio cache: {len(self.entries)} tracks, {self.total_bytes // 2**20} MB")
+
+    def lookup(self, key):
+        meta = self.entries.get(key)
+        if meta is None:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        try:
+            # The file mtime carries the LRU order across restarts
+            os.utime(meta['url'])
+        except OSError:
+            self._drop(key)
+            return None
+        return meta
+
+    async def record_play(self, data):
+        """Count a network play and start filling the cache once a track is popular enough"""
+        key = track_key(data)
+        if not self.enabled or key is None:
+            return
+        # Live streams and anything larger than the whole cache are never stored
+        duration = data.get('duration')
+        if not duration or duration * self.bitrate * 125 > self.max_bytes:
+            return
+        if key in self.entries or key in self.filling:
+            return
+        plays = await asyncio.to_thread(state_store.count_play, key)
+        if plays >= self.min_plays:
+            self.filling.add(key)
+            asyncio.create_task(self._fill(key, dict(data)))
+
+    async def _fill(self, key, data):
+        try:
+            # One transcode at a time so filling never competes with live playback for CPU
+            async with self.fill_lock:
+                permit = await resource_governor.acquire(None, 'cache', PRIORITY_BACKGROUND)
+                try:
+                    await self._transcode(key, data)
+                finally:
+                    permit.release()
+        except Exception as e:
+            logging.error(f"Error caching audio for {key}: {e}")
+        finally:
+            self.filling.discard(key)
+
+    async def _transcode(self, key, data):
+        path = self._path(key, '.opus')
+        part = path + '.part'
+        if data.get('acodec') == 'opus':
+            codec = ['-c:a', 'copy']
+            abr = data.get('abr')
+        else:
+            codec = ['-c:a', 'libopus', '-b:a', f'{self.bitrate}k', '-ar', '48000', '-ac', '2']
+            abr = self.bitrate
+        args = ['ffmpeg', '-nostdin', '-loglevel', 'error', *ffmpeg_options['before_options'].split(),
+                '-i', data['url'], '-vn', '-map_metadata', '-1', *codec, '-f', 'ogg', part]
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        lower_priority(process.pid, 10)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            if os.path.exists(part):
+                os.remove(part)
+            raise RuntimeError(stderr.decode(errors='replace').strip() or f"ffmpeg exited with {process.returncode}")
+
+        os.replace(part, path)
+        meta = {
+            'key': key, 'url': path, 'title': data.get('title'), 'duration': data.get('duration'),
+            'uploader': data.get('uploader'), 'webpage_url': data.get('webpage_url'),
+            'acodec': 'opus', 'abr': abr, 'cached': True,
+        }
+        with open(self._path(key, '.json'), 'w') as f:
+            json.dump(meta, f)
+        meta['filesize'] = os.path.getsize(path)
+        self.entries[key] = meta
+        self.total_bytes += meta['filesize']
+        self.fills += 1
+        self._evict()
+        logging.info(f"Cached audio for {data.get('title')} ({meta['filesize'] // 1024} KB)")
+
+    def _drop(self, key):
+        meta = self.entries.pop(key, None)
+        if meta is None:
+            return
+        self.total_bytes -= meta['filesize']
+        for path in (meta['url'], self._path(key, '.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def stats(self):
+        if not self.enabled:
+            return "disabled"
+        return (f"{len(self.entries)} tracks, {self.total_bytes / 2**20:.0f}/{self.max_bytes / 2**20:.0f} MB, "
+                f"{self.hits} hits, {self.fills} filled, {self.evictions} evicted, {len(self.filling)} filling")
+
+audio_cache = AudioCache(
+    config.get("audio_cache_dir", ""),
+    max_bytes=config.get("audio_cache_max_mb", 2048) * 2**20,
+    min_plays=config.get("audio_cache_min_plays", 3),
+    bitrate=config.get("stream_bitrate", 128),
+)
+
+LOUDNESS_RE = re.compile(r'I:\s+(-?[\d.]+) LUFS')
+
+class LoudnessAnalyzer:
+    """Measures EBU R128 integrated loudness once per track so playback can be normalized for free"""
+    def __init__(self, enabled=True, target=-14.0, max_boost_db=6.0, max_cut_db=20.0, max_duration=3600):
+        self.enabled = enabled
+        self.target = target
+        self.max_boost_db = max_boost_db
+        self.max_cut_db = max_cut_db
+        self.max_duration = max_duration
+        # track key -> integrated loudness in LUFS
+        self.levels = {}
+        self.pending = set()
+        self.analysis_lock = asyncio.Lock()
+        self.measured = 0
+        self.failed = 0
+
+    def load(self):
+        if self.enabled:
+            self.levels.update(state_store.load_loudness())
+
+    def gain(self, data):
+        """Linear gain that brings a track to the target loudness, 1.0 until it has been measured"""
+        lufs = self.levels.get(track_key(data)) if self.enabled else None
+        if lufs is None:
+            return 1.0
+        db = min(max(self.target - lufs, -self.max_cut_db), self.max_boost_db)
+        return round(10 ** (db / 20), 3)
+
+    def schedule(self, data):
+        key = track_key(data)
+        # Measurements are only worth taking when they can be stored
+        if not self.enabled or state_store.db is None or key is None or key in self.levels or key in self.pending:
+            return
+        # Live streams have no integrated loudness, very long uploads aren't worth downloading twice
+        duration = data.get('duration')
+        if not duration or duration > self.max_duration:
+            return
+        self.pending.add(key)
+        asyncio.create_task(self._analyze(key, data))
+
+    async def _analyze(self, key, data):
+        try:
+            # One niced ffmpeg at a time, admitted only when playback leaves room for it
+            async with self.analysis_lock:
+                permit = await resource_governor.acquire(None, 'loudness', PRIORITY_BACKGROUND)
+                try:
+                    lufs = await self._measure(data)
+                finally:
+                    permit.release()
+            await asyncio.to_thread(state_store.save_loudness, key, lufs)
+            self.levels[key] = lufs
+            self.measured += 1
+            logging.info(f"Loudness of {data.get('title')}: {lufs:.1f} LUFS")
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Error measuring loudness for {key}: {e}")
+        finally:
+            self.pending.discard(key)
+
+    async def _measure(self, data):
+        args = ['ffmpeg', '-nostdin', '-hide_banner', '-nostats',
+                *source_before_options(local=data.get('cached')).split(),
+                '-i', data['url'], '-vn', '-af', 'ebur128=framelog=quiet', '-f', 'null', '-']
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        lower_priority(process.pid, 15)
+        _, stderr = await process.communicate()
+        output = stderr.decode(errors='replace')
+        # The summary comes last, after any per-stream messages
+        matches = LOUDNESS_RE.findall(output)
+        if process.returncode != 0 or not matches:
+            raise RuntimeError(output.strip().splitlines()[-1] if output.strip() else f"ffmpeg exited with {process.returncode}")
+        return float(matches[-1])
+
+    def stats(self):
+        if not self.enabled:
+            return "disabled"
+        return (f"{len(self.levels)} tracks measured (target {self.target:.0f} LUFS), {len(self.pending)} pending, "
+                f"{self.failed} failed")
+
+loudness = LoudnessAnalyzer(
+    enabled=config.get("loudness_normalization", True),
+    target=config.get("loudness_target", -14),
+    max_boost_db=config.get("loudness_max_boost_db", 6),
+)
+
+class YTDLSource(FFmpegPCMAudio):
+    def __init__(self, url, *, data, start=0):
+        # Raw PCM; volume and transitions are handled by the guild's PCMMixer
+        options = ffmpeg_options['options']
+        gain = data.get('gain') or 1.0
+        if gain != 1.0:
+            # Loudness normalization costs nothing extra as part of ffmpeg's decode
+            options += f" -af volume={gain:.3f}"
+        super().__init__(url, before_options=source_before_options(start, data.get('cached')), options=options)
+        metrics.track_ffmpeg(self)
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.duration = data.get('duration')
+        self.uploader = data.get('uploader')
+
+    @classmethod
+    async def create_source(cls, search: str, *, guild_id=None, volume=0.5, bitrate=None, start=0, on_queued=None):
+        try:
+            # Popular tracks play from the local audio cache without touching yt-dlp or the network
+            data = audio_cache.lookup(normalize_query(search))
+            if data is None:
+                # Extract info from YouTube, reusing recent resolutions
+                data = await resolution_cache.resolve(search, guild_id=guild_id)
+                if track_key(data):
+                    data = audio_cache.lookup(track_key(data)) or data
+                if not data.get('cached'):
+                    asyncio.create_task(audio_cache.record_play(data))
+            # Normalize with the stored loudness; a track not measured yet plays as is and is measured for next time
+            loudness.schedule(data)
+            data = dict(data, gain=loudness.gain(data))
+            
+            # Get the direct URL for streaming
+            url = data['url']
+            # Each track holds a slot for its ffmpeg process until the source is cleaned up
+            permit = await resource_governor.acquire(guild_id, 'track', on_queued=on_queued)
+            try:
+                if audio_workers.enabled and not opus_passthrough:
+                    # An audio worker spawns ffmpeg and buffers, this process only describes the track
+                    return RemoteTrack(url, data=data, start=start, permit=permit)
+                if opus_passthrough:
+                    source = await YTDLOpusSource.create(url, data=data, volume=volume, bitrate=bitrate, start=start)
+                else:
+                    source = cls(url, data=data, start=start)
+            except Exception:
+                permit.release()
+                raise
+            # Read ahead on a dedicated thread so network hiccups don't reach the player
+            source = BufferedSource(source, prebuffer=prebuffer_seconds, permit=permit)
+            await source.wait_ready(timeout=prebuffer_seconds + 5)
+            return source
+        except Exception as e:
+            logging.error(f"Error creating YouTube source: {e}")
+            return None
+
+class YTDLOpusSource(discord.FFmpegOpusAudio):
+    def __init__(self, url, *, data, volume=0.5, bitrate=128, codec=None, start=0):
+        # Volume lives in the ffmpeg filter graph, so there is no per-frame work in Python
+        options = '-vn -loglevel error'
+        if codec != 'copy':
+            options += f' -af volume={volume:.2f}'
+        super().__init__(url, bitrate=bitrate, codec=codec,
+                         before_options=source_before_options(start, data.get('cached')), options=options)
+        metrics.track_ffmpeg(self)
+        self.data = data
+        self.title = data.get('title')
+        self.url = url
+        self.duration = data.get('duration')
+        self.uploader = data.get('uploader')
+
+    @classmethod
+    async def create(cls, url, *, data, volume=0.5, bitrate=None, start=0):
+        codec = data.get('acodec')
+        if not codec or codec == 'none':
+            codec, _ = await cls.probe(url)
+
+        # Match the voice channel's bitrate; Discord caps Opus at 510 kbps
+        kbps = min(max((bitrate or 128000) // 1000, 16), 510)
+
+        # The player volume and the track's loudness gain share one filter
+        volume *= data.get('gain') or 1.0
+        # Opus at full volume and within the channel bitrate can be copied without re-encoding
+        if codec == 'opus' and abs(volume - 1.0) < 0.01 and (data.get('abr') or 0) <= kbps:
+            return cls(url, data=data, volume=1.0, bitrate=kbps, codec='copy', start=start)
+        return cls(url, data=data, volume=volume, bitrate=kbps, start=start)
+
+FRAME_SAMPLES = 960  # 20 ms of 48 kHz audio per channel
+FRAME_SIZE = FRAME_SAMPLES * 4  # 16-bit stereo
+SILENCE_FRAME = bytes(FRAME_SIZE)
+# A 20 ms Opus frame of silence, sent while waiting for upstream audio
+OPUS_SILENCE = b'\xf8\xff\xfe'
+# libopus packs a frame of digital silence into a handful of bytes
+SILENT_OPUS_BYTES = 10
+
+prebuffer_seconds = config.get("prebuffer_seconds", 2)
+
+def stream_prebuffer(url):
+    # additional_streams entries may set their own prebuffer_seconds
+    for stream in configured_streams:
+        if stream['url'] == url and 'prebuffer_seconds' in stream:
+            return stream['prebuffer_seconds']
+    return prebuffer_seconds
+
+class BufferedSource(discord.AudioSource):
+    def __init__(self, source, *, prebuffer=2.0, capacity=None, permit=None):
+        self.source = source
+        self.permit = permit
+        self.opus = source.is_opus()
+        self.prebuffer_frames = max(1, int(prebuffer * 50))
+        self.rebuffer_frames = max(1, self.prebuffer_frames // 2)
+        self.capacity = max(int((capacity or prebuffer * 2) * 50), self.prebuffer_frames + 50)
+        # Preallocated storage: one contiguous buffer for PCM, fixed slots for Opus packets
+        if self.opus:
+            self.slots = [None] * self.capacity
+        else:
+            self.buffer = memoryview(bytearray(self.capacity * FRAME_SIZE))
+        self.read_pos = 0
+        self.write_pos = 0
+        self.cond = threading.Condition()
+        self.primed = False
+        self.eof = False
+        self.closed = False
+        self.underruns = 0
+        self.silent_frames = 0
+        self.spawned_at = time.perf_counter()
+        self.clock = FrameClock()
+        self.on_first_audio = None
+        self.thread = threading.Thread(target=self._fill, name="prebuffer", daemon=True)
+        self.thread.start()
+
+    def is_opus(self):
+        return self.opus
+
+    def _fill(self):
+        try:
+            while not self.closed:
+                data = self.source.read()
+                if not data:
+                    break
+                with self.cond:
+                    while self.write_pos - self.read_pos >= self.capacity and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                    slot = self.write_pos % self.capacity
+                    if self.opus:
+                        self.slots[slot] = data
+                    else:
+                        self.buffer[slot * FRAME_SIZE:(slot + 1) * FRAME_SIZE] = data
+                    self.write_pos += 1
+                if self.write_pos == 1:
+                    metrics.first_frame.observe(time.perf_counter() - self.spawned_at, 'track')
+        except Exception as e:
+            logging.error(f"Prebuffer reader failed: {e}")
+        finally:
+            with self.cond:
+                self.eof = True
+
+    def fill(self):
+        return self.write_pos - self.read_pos
+
+    def ready(self):
+        return self.eof or self.fill() >= self.prebuffer_frames
+
+    async def wait_ready(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not self.ready() and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+
+    def read(self):
+        self.clock.tick()
+        with self.cond:
+            available = self.write_pos - self.read_pos
+            if not self.primed:
+                # Serve silence until enough audio is buffered (again, after an underrun)
+                threshold = self.rebuffer_frames if self.underruns else self.prebuffer_frames
+                if available >= threshold or (self.eof and available):
+                    self.primed = True
+            if not (self.primed and available):
+                if self.eof and not available:
+                    return b''
+                if self.primed:
+                    self.primed = False
+                    self.underruns += 1
+                    logging.warning(f"Audio buffer underrun ({self.underruns} so far), padding with silence")
+                self.silent_frames += 1
+                return OPUS_SILENCE if self.opus else SILENCE_FRAME
+            slot = self.read_pos % self.capacity
+            if self.opus:
+                frame = self.slots[slot]
+                self.slots[slot] = None
+            else:
+                frame = bytes(self.buffer[slot * FRAME_SIZE:(slot + 1) * FRAME_SIZE])
+            self.read_pos += 1
+            self.cond.notify_all()
+        if self.on_first_audio:
+            self.on_first_audio()
+            self.on_first_audio = None
+        return frame
+
+    def stats(self):
+        return (f"buffer {self.fill() / 50:.1f}s/{self.capacity / 50:.1f}s, "
+                f"{self.underruns} underruns ({self.silent_frames / 50:.1f}s silence)")
+
+    def cleanup(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.source.cleanup()
+        if self.permit:
+            self.permit.release()
+
+def pcm_to_float(data):
+    return np.frombuffer(data, dtype=np.int16).reshape(-1, 2).astype(np.float32) * (1 / 32768)
+
+def soft_clip(samples, knee=0.8):
+    # Compress peaks above the knee smoothly instead of hard clipping at full scale
+    magnitude = np.abs(samples)
+    over = magnitude > knee
+    if over.any():
+        excess = (magnitude[over] - knee) / (1 - knee)
+        samples[over] = np.sign(samples[over]) * (knee + (1 - knee) * np.tanh(excess))
+    return samples
+
+class PCMMixer(discord.AudioSource):
+    def __init__(self, *, volume=0.5, crossfade=3.0, ramp=0.1, on_track_end=None, idle_timeout=30):
+        self.lock = threading.Lock()
+        self.current = None
+        self.outgoing = None
+        self.on_track_end = on_track_end
+        self.end_signalled = False
+        self.finished = False
+        self.ended = False
+        self.frames_played = 0
+        self.end_frame = None
+        self.idle_frames = 0
+        self.idle_limit = int(idle_timeout * 50)
+        self.crossfade = crossfade
+
+        # Equal-power crossfade curves, precomputed once per mixer
+        self.fade_frames = max(1, int(crossfade * 50))
+        self.fade_pos = self.fade_frames
+        curve = np.linspace(0, np.pi / 2, self.fade_frames * FRAME_SAMPLES, dtype=np.float32)
+        self.fade_in = np.sin(curve)[:, None]
+        self.fade_out = np.cos(curve)[:, None]
+
+        self.gain = volume
+        self.target_gain = volume
+        self.ramp_step = 1 / max(1, ramp * 50)
+
+    @property
+    def volume(self):
+        return self.target_gain
+
+    @volume.setter
+    def volume(self, value):
+        # Ramped in read() so volume changes don't click
+        self.target_gain = max(value, 0.0)
+
+    def crossfade_to(self, source, duration=None):
+        with self.lock:
+            if self.current is not None:
+                if self.outgoing is not None:
+                    self.outgoing.cleanup()
+                self.outgoing = self.current
+                self.fade_pos = 0
+            elif self.outgoing is None:
+                self.fade_pos = self.fade_frames
+            self.current = source
+            self.frames_played = 0
+            # Ask for the next track early so it can fade in under the end of this one
+            self.end_frame = int(duration * 50) - self.fade_frames if duration and self.crossfade else None
+            self.end_signalled = False
+            self.finished = False
+
+    def skip(self):
+        with self.lock:
+            if self.current is None:
+                return False
+            if self.outgoing is not None:
+                self.outgoing.cleanup()
+            self.outgoing = self.current
+            self.current = None
+            self.fade_pos = 0
+            self._signal_end()
+            return True
+
+    def finish(self):
+        # No next track is coming, end once the current audio plays out
+        with self.lock:
+            self.finished = True
+            if self.current is not None:
+                # The early end signal was only for a crossfade, signal again at the real end
+                self.end_signalled = False
+                return True
+            return False
+
+    def _signal_end(self):
+        if not self.end_signalled:
+            self.end_signalled = True
+            if self.on_track_end:
+                self.on_track_end()
+
+    def read(self):
+        with self.lock:
+            mix = None
+            if self.current is not None:
+                data = self.current.read()
+                if len(data) == FRAME_SIZE:
+                    mix = pcm_to_float(data)
+                    self.frames_played += 1
+                    if self.end_frame is not None and self.frames_played >= self.end_frame:
+                        self._signal_end()
+                else:
+                    self.current.cleanup()
+                    self.current = None
+                    self._signal_end()
+
+            if self.fade_pos < self.fade_frames:
+                window = slice(self.fade_pos * FRAME_SAMPLES, (self.fade_pos + 1) * FRAME_SAMPLES)
+                self.fade_pos += 1
+                if mix is not None:
+                    mix *= self.fade_in[window]
+                if self.outgoing is not None:
+                    data = self.outgoing.read()
+                    if len(data) == FRAME_SIZE:
+                        faded = pcm_to_float(data) * self.fade_out[window]
+                        mix = faded if mix is None else mix + faded
+            if self.outgoing is not None and self.fade_pos >= self.fade_frames:
+                self.outgoing.cleanup()
+                self.outgoing = None
+
+            if mix is None:
+                self.idle_frames += 1
+                if (self.finished and self.outgoing is None) or self.idle_frames > self.idle_limit:
+                    self.ended = True
+                    return b''
+                return SILENCE_FRAME
+            self.idle_frames = 0
+
+            gain = self.gain
+            if gain != self.target_gain:
+                step = min(max(self.target_gain - gain, -self.ramp_step), self.ramp_step)
+                self.gain = gain + step
+                mix *= np.linspace(gain, self.gain, FRAME_SAMPLES, dtype=np.float32)[:, None]
+            elif gain != 1.0:
+                mix *= gain
+
+            return (soft_clip(mix) * 32767).astype(np.int16).tobytes()
+
+    def cleanup(self):
+        with self.lock:
+            for source in (self.current, self.outgoing):
+                if source is not None:
+                    source.cleanup()
+            self.current = None
+            self.outgoing = None
+            self.ended = True
+
+# Audio worker processes: decoding, mixing and Opus encoding run outside the gateway process's GIL
+class RemoteTrack:
+    """A track for an audio worker to decode; only its description lives in this process"""
+    def __init__(self, url, *, data, start=0, permit=None):
+        self.url = url
+        self.permit = permit
+        self.data = {key: data.get(key) for key in ('title', 'duration', 'uploader', 'cached', 'gain')}
+        self.title = data.get('title')
+        self.start = start
+        self.duration = None
+        self.serial = None
+        self.read_pos = 0
+        self.on_first_audio = None
+
+    def is_opus(self):
+        return False
+
+    def spec(self):
+        # A track moved to another worker resumes after the frames already heard
+        return {'url': self.url, 'data': self.data, 'start': self.start + self.read_pos / 50}
+
+    def cleanup(self):
+        if self.permit:
+            self.permit.release()
+
+class WorkerSession:
+    def __init__(self, volume, crossfade, idle_timeout):
+        self.mixer = PCMMixer(volume=volume, crossfade=crossfade, idle_timeout=idle_timeout,
+                              on_track_end=self._on_track_end)
+        self.encoder = discord.opus.Encoder()
+        self.credits = 0
+        self.serial = None
+        # (serial, source, duration, deadline) of a track still prebuffering
+        self.pending = None
+        self.track_ended = False
+        self.playing_out = False
+        self.ended = False
+
+    def _on_track_end(self):
+        # Runs inside the mixer; an early signal comes while the track is still playing
+        self.track_ended = True
+        self.playing_out = self.mixer.current is not None
+
+    def finish(self):
+        if not self.mixer.finish() and self.playing_out:
+            # The real end came before this message and was swallowed by the early signal
+            self.track_ended = True
+            self.playing_out = False
+
+    def play(self, serial, spec, duration):
+        try:
+            source = BufferedSource(YTDLSource(spec['url'], data=spec['data'], start=spec['start']),
+                                    prebuffer=prebuffer_seconds)
+        except Exception as e:
+            logging.error(f"Audio worker could not start {spec['data'].get('title')}: {e}")
+            self.track_ended = True
+            return
+        if self.pending is not None:
+            self.pending[1].cleanup()
+        self.pending = (serial, source, duration, time.monotonic() + prebuffer_seconds + 5)
+
+    def start_pending(self):
+        # Same as create_source's wait_ready: the outgoing track keeps playing until the new one has audio
+        if self.pending is None:
+            return
+        serial, source, duration, deadline = self.pending
+        if source.ready() or time.monotonic() > deadline:
+            self.pending = None
+            self.serial = serial
+            self.mixer.crossfade_to(source, duration)
+
+    def cleanup(self):
+        if self.pending is not None:
+            self.pending[1].cleanup()
+            self.pending = None
+        self.mixer.cleanup()
+
+def audio_worker_main(conn):
+    """Entry point of an audio worker process"""
+    # Ctrl+C is handled by the parent, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sessions = {}
+
+    def fail(sid, error):
+        # One guild's failure ends only that guild's session, the parent logs why
+        session = sessions.pop(sid, None)
+        if session is not None:
+            try:
+                session.cleanup()
+            except Exception:
+                pass
+        conn.send(('error', sid, f"{type(error).__name__}: {error}"))
+        conn.send(('ended', sid))
+
+    while True:
+        # Only block on the pipe when no session has credit to produce frames
+        busy = any(session.credits > 0 and not session.ended for session in sessions.values())
+        while conn.poll(0 if busy else 0.02):
+            message = conn.recv()
+            kind, sid = message[0], message[1] if len(message) > 1 else None
+            session = sessions.get(sid)
+            if kind == 'exit':
+                for session in sessions.values():
+                    session.cleanup()
+                return
+            try:
+                if kind == 'ping':
+                    conn.send(('pong', sid))
+                elif kind == 'open':
+                    sessions[sid] = WorkerSession(*message[2:])
+                elif session is None:
+                    continue
+                elif kind == 'play':
+                    session.play(*message[2:])
+                elif kind == 'credit':
+                    session.credits += message[2]
+                elif kind == 'volume':
+                    session.mixer.volume = message[2]
+                elif kind == 'skip':
+                    session.mixer.skip()
+                elif kind == 'finish':
+                    session.finish()
+                elif kind == 'close':
+                    session.cleanup()
+                    del sessions[sid]
+            except Exception as e:
+                fail(sid, e)
+            busy = any(session.credits > 0 and not session.ended for session in sessions.values())
+
+        for sid, session in list(sessions.items()):
+            packets = []
+            try:
+                session.start_pending()
+                while session.credits > 0 and not session.ended and len(packets) < 10:
+                    frame = session.mixer.read()
+                    if not frame:
+                        session.ended = True
+                        break
+                    session.credits -= 1
+                    # Silence needs no encoding and tells the parent no audio was heard yet
+                    packets.append(OPUS_SILENCE if frame == SILENCE_FRAME
+                                   else session.encoder.encode(frame, FRAME_SAMPLES))
+            except Exception as e:
+                fail(sid, e)
+                continue
+            if packets:
+                conn.send(('frames', sid, session.serial, packets))
+            if session.track_ended:
+                session.track_ended = False
+                conn.send(('track_end', sid, session.playing_out))
+            if session.ended:
+                conn.send(('ended', sid))
+                session.cleanup()
+                del sessions[sid]
+
+class AudioWorker:
+    def __init__(self, pool, index, context):
+        self.pool = pool
+        self.index = index
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=audio_worker_main, args=(child,), name=f"audio-worker-{index}",
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.send_lock = threading.Lock()
+        self.mixers = {}
+        self.started_at = time.monotonic()
+        self.last_pong = None
+        self.alive = True
+        threading.Thread(target=self._receive, name=f"audio-worker-{index}-rx", daemon=True).start()
+
+    def send(self, *message):
+        # Called from the event loop and from player threads
+        try:
+            with self.send_lock:
+                self.conn.send(message)
+        except (OSError, ValueError):
+            self.alive = False
+
+    def _receive(self):
+        try:
+            while True:
+                message = self.conn.recv()
+                if message[0] == 'pong':
+                    self.last_pong = time.monotonic()
+                    continue
+                if message[0] == 'error':
+                    logging.error(f"Audio worker {self.index} ended guild session {message[1]}: {message[2]}")
+                    continue
+                mixer = self.mixers.get(message[1])
+                if mixer is not None:
+                    mixer.on_message(message)
+        except (EOFError, OSError):
+            pass
+        if self.alive:
+            self.alive = False
+            self.pool.worker_died(self)
+
+    def healthy(self, timeout):
+        if not self.alive or not self.process.is_alive():
+            return False
+        if self.last_pong is None:
+            # A fresh worker is still importing; give it longer to answer its first ping
+            return time.monotonic() - self.started_at < timeout * 5
+        return time.monotonic() - self.last_pong < timeout
+
+    def stop(self):
+        self.alive = False
+        self.send('exit')
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+class AudioWorkerPool:
+    def __init__(self, workers=0, health_interval=2, health_timeout=6, max_moves=3):
+        self.size = workers
+        self.max_moves = max_moves
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        # Spawned, not forked: the gateway process has threads and an event loop that must not be copied
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        # Workers whose restart is under way, so a second health check doesn't restart them again
+        self.replacing = set()
+        self.restarts = 0
+        self.loop = None
+        self.task = None
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.workers = [AudioWorker(self, index, self.context) for index in range(self.size)]
+        self.task = self.loop.create_task(self._health_checks())
+        logging.info(f"Started {self.size} audio workers")
+
+    def assign(self, mixer):
+        # The least loaded live worker takes the guild
+        candidates = [worker for worker in self.workers if worker.alive] or self.workers
+        worker = min(candidates, key=lambda w: len(w.mixers))
+        worker.mixers[mixer.sid] = mixer
+        return worker
+
+    def release(self, mixer):
+        mixer.worker.mixers.pop(mixer.sid, None)
+
+    async def _health_checks(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker in list(self.workers):
+                worker.send('ping', None)
+                if not worker.healthy(self.health_timeout):
+                    await self._replace(worker)
+
+    def worker_died(self, worker):
+        # Called from the worker's receiver thread
+        asyncio.run_coroutine_threadsafe(self._replace(worker), self.loop)
+
+    def _respawn(self, worker):
+        worker.stop()
+        return AudioWorker(self, worker.index, self.context)
+
+    async def _replace(self, worker):
+        if worker not in self.workers or worker in self.replacing:
+            return
+        # No new guilds for it while it is being replaced
+        worker.alive = False
+        self.replacing.add(worker)
+        logging.error(f"Audio worker {worker.index} is unresponsive, restarting it "
+                      f"and moving {len(worker.mixers)} guilds")
+        try:
+            # Joining the old process and spawning the new one block for a second or more
+            replacement = await asyncio.to_thread(self._respawn, worker)
+        except Exception as e:
+            logging.error(f"Error restarting audio worker {worker.index}: {e}")
+            return
+        finally:
+            self.replacing.discard(worker)
+        if worker not in self.workers:
+            # Shut down in the meantime
+            replacement.stop()
+            return
+        self.workers[self.workers.index(worker)] = replacement
+        self.restarts += 1
+        now = time.monotonic()
+        for mixer in list(worker.mixers.values()):
+            # Only restarts close together count against a guild
+            mixer.moves = mixer.moves + 1 if now - mixer.moved_at < 60 else 1
+            mixer.moved_at = now
+            if mixer.moves > self.max_moves:
+                # Most likely this guild's audio is what keeps taking workers down
+                logging.error(f"Giving up on guild session {mixer.sid} after {self.max_moves} worker restarts")
+                worker.mixers.pop(mixer.sid, None)
+                mixer.worker_ended = True
+                continue
+            mixer.move_to(self.assign(mixer))
+
+    def shutdown(self):
+        if self.task:
+            self.task.cancel()
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def stats(self):
+        if not self.enabled:
+            return "in-process"
+        load = "/".join(str(len(worker.mixers)) if worker.alive else "down" for worker in self.workers)
+        return f"{len(self.workers)} workers, guilds per worker {load}, {self.restarts} restarts"
+
+audio_workers = AudioWorkerPool(config.get("audio_workers", 0))
+
+class RemoteMixer(discord.AudioSource):
+    """Stands in for PCMMixer while an audio worker does the mixing and encoding"""
+    ids = itertools.count(1)
+
+    def __init__(self, pool, *, volume=0.5, crossfade=3.0, on_track_end=None, idle_timeout=30, window=25):
+        self.sid = next(RemoteMixer.ids)
+        self.pool = pool
+        self.options = (crossfade, idle_timeout)
+        self.target_gain = volume
+        self.on_track_end = on_track_end
+        self.window = window
+        self.packets = deque()
+        self.current = None
+        self.tracks = {}
+        self.serials = itertools.count(1)
+        self.finished = False
+        self.playing_out = False
+        self.worker_ended = False
+        self.ended = False
+        self.closed = False
+        self.consumed = 0
+        self.underruns = 0
+        self.moves = 0
+        self.moved_at = 0.0
+        self.worker = pool.assign(self)
+        self._open()
+
+    def _open(self):
+        self.worker.send('open', self.sid, self.target_gain, *self.options)
+        # Credits bound how far the worker may run ahead of the player thread
+        self.worker.send('credit', self.sid, self.window)
+
+    def _play(self, track):
+        spec = track.spec()
+        remaining = track.duration - (spec['start'] - track.start) if track.duration else None
+        self.worker.send('play', self.sid, track.serial, spec, remaining)
+
+    def is_opus(self):
+        return True
+
+    @property
+    def volume(self):
+        return self.target_gain
+
+    @volume.setter
+    def volume(self, value):
+        self.target_gain = max(value, 0.0)
+        self.worker.send('volume', self.sid, self.target_gain)
+
+    def crossfade_to(self, track, duration=None):
+        track.serial = next(self.serials)
+        track.duration = duration
+        # Keep the outgoing track too, its frames may still be queued here
+        for t in self.tracks.values():
+            if t is not self.current:
+                t.cleanup()
+        self.tracks = {serial: t for serial, t in self.tracks.items() if t is self.current}
+        self.tracks[track.serial] = track
+        self.current = track
+        self.finished = False
+        self._play(track)
+
+    def skip(self):
+        if self.current is None:
+            return False
+        self.worker.send('skip', self.sid)
+        return True
+
+    def finish(self):
+        # Same contract as PCMMixer.finish, the worker reported whether its track is still playing
+        self.finished = True
+        self.worker.send('finish', self.sid)
+        return self.playing_out
+
+    def move_to(self, worker):
+        # The old worker's buffered frames are gone; resume each track where the listener is
+        self.worker = worker
+        self.packets.clear()
+        self.worker_ended = False
+        self._open()
+        if self.current is not None:
+            self._play(self.current)
+        if self.finished:
+            self.worker.send('finish', self.sid)
+
+    def on_message(self, message):
+        # Runs on the worker's receiver thread
+        kind = message[0]
+        if kind == 'frames':
+            serial = message[2]
+            self.packets.extend((serial, packet) for packet in message[3])
+        elif kind == 'track_end':
+            self.playing_out = message[2]
+            if self.on_track_end:
+                self.on_track_end()
+        elif kind == 'ended':
+            self.worker_ended = True
+
+    def read(self):
+        if self.packets:
+            serial, packet = self.packets.popleft()
+            self.consumed += 1
+            if self.consumed % 10 == 0:
+                self.worker.send('credit', self.sid, 10)
+            track = self.tracks.get(serial)
+            if track is not None and packet != OPUS_SILENCE:
+                track.read_pos += 1
+                if track.on_first_audio:
+                    track.on_first_audio()
+                    track.on_first_audio = None
+            return packet
+        if self.worker_ended:
+            self.ended = True
+            return b''
+        self.underruns += 1
+        return OPUS_SILENCE
+
+    def stats(self):
+        return (f"audio worker {self.worker.index}, buffer {len(self.packets) / 50:.1f}s/{self.window / 50:.1f}s, "
+                f"{self.underruns} underrun frames")
+
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            self.ended = True
+            self.worker.send('close', self.sid)
+            self.pool.release(self)
+            for track in self.tracks.values():
+                track.cleanup()
+
+class Track:
+    # Queue entries only hold metadata; the audio source is created by play_next
+    __slots__ = ('kind', 'title', 'url', 'duration', 'uploader', 'video_id')
+
+    def __init__(self, kind, title, url, duration=None, uploader=None, video_id=None):
+        self.kind = kind
+        self.title = title
+        self.url = url
+        self.duration = duration
+        self.uploader = uploader
+        self.video_id = video_id
+
+    @classmethod
+    def from_info(cls, info, url=None):
+        return cls(
+            'youtube',
+            info.get('title') or 'Unknown',
+            info.get('webpage_url') or url or '',
+            duration=info.get('duration'),
+            uploader=info.get('uploader') or info.get('channel') or 'Unknown',
+            video_id=info.get('id'),
+        )
+
+    def to_tuple(self):
+        return (self.kind, self.title, self.url, self.duration, self.uploader, self.video_id)
+
+    def __repr__(self):
+        return f"Track({self.kind!r}, {self.title!r})"
+
+class MusicQueue:
+    def __init__(self):
+        self.queue = deque()
+        self.current_track = None
+        self.repeat_mode = False
+        self.shuffle_mode = False
+
+    def add_track(self, track_info):
+        if self.shuffle_mode and self.queue:
+            # Keep the upcoming order randomized so prefetch resolves what actually plays next
+            self.queue.insert(random.randint(0, len(self.queue)), track_info)
+        else:
+            self.queue.append(track_info)
+
+    def add_playlist(self, playlist_tracks):
+        self.queue.extend(playlist_tracks)
+        if self.shuffle_mode:
+            self.shuffle()
+
+    def remove(self, index):
+        track = self.queue[index]
+        del self.queue[index]
+        return track
+
+    def move(self, from_index, to_index):
+        track = self.remove(from_index)
+        self.queue.insert(to_index, track)
+        return track
+
+    def shuffle(self):
+        # Shuffling a list is O(n); indexing into a deque from random.shuffle is not
+        tracks = list(self.queue)
+        random.shuffle(tracks)
+        self.queue.clear()
+        self.queue.extend(tracks)
+
+    def get_next_track(self):
+        if self.repeat_mode and self.current_track:
+            return self.current_track
+        
+        if self.queue:
+            self.current_track = self.queue.popleft()
+            return self.current_track
+        return None
+
+    def skip_track(self):
+        if self.queue:
+            self.current_track = self.queue.popleft()
+            return self.current_track
+        return None
+
+    def clear(self):
+        self.queue.clear()
+        self.current_track = None
+
+    def get_queue_info(self):
+        return list(self.queue)
+
+    def is_empty(self):
+        return len(self.queue) == 0 and self.current_track is None
+
+class GuildPlayer:
+    def __init__(self, guild_id, volume=0.5):
+        self.guild_id = guild_id
+        self.queue = MusicQueue()
+        self.volume = volume
+        self.is_playing_stream = False
+        self.stream_url = None
+        self.current_source = None
+        self.mixer = None
+        self.now_playing_message = None
+        self.now_playing_channel = None
+        self.last_active = time.monotonic()
+        self.prefetch_task = None
+        self.prefetch_dirty = False
+        self.track_offset = 0
+        self.pending_offset = 0
+        self.command_started = None
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def mark_command(self, command):
+        self.command_started = (command, time.perf_counter())
+
+    def watch_first_audio(self, source):
+        # Report command-to-audio latency once the player thread hands out the first real frame
+        if self.command_started is None:
+            return
+        command, started = self.command_started
+        self.command_started = None
+        if time.perf_counter() - started < 120:
+            source.on_first_audio = lambda: metrics.command_to_audio.observe(time.perf_counter() - started, command)
+
+    def position(self):
+        # Seconds into the current track, counted from frames actually handed to the player
+        if isinstance(self.current_source, (BufferedSource, RemoteTrack)):
+            return self.track_offset + self.current_source.read_pos / 50
+        return self.track_offset
+
+    def schedule_prefetch(self):
+        # Resolve upcoming tracks in the background; ffmpeg is only started by play_next
+        if prefetch_depth <= 0:
+            return
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_dirty = True
+            return
+        self.prefetch_task = asyncio.ensure_future(self._prefetch())
+
+    async def _prefetch(self):
+        self.prefetch_dirty = True
+        while self.prefetch_dirty:
+            self.prefetch_dirty = False
+            upcoming = list(itertools.islice(self.queue.queue, prefetch_depth))
+            for track in upcoming:
+                if track.kind != 'youtube':
+                    continue
+                try:
+                    # Prefetching yields to audible playback when the bot is busy
+                    permit = await resource_governor.acquire(None, 'prefetch', PRIORITY_BACKGROUND)
+                    try:
+                        data = await resolution_cache.resolve(track.url, guild_id=self.guild_id)
+                    finally:
+                        permit.release()
+                    loudness.schedule(data)
+                except Exception as e:
+                    logging.warning(f"Prefetch failed for {track.title}: {e}")
+
+    def is_idle(self, voice_client, idle_timeout):
+        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            return False
+        return time.monotonic() - self.last_active > idle_timeout
+
+class PlayerRegistry:
+    def __init__(self, idle_timeout=600, max_players=500):
+        self.players = OrderedDict()
+        self.idle_timeout = idle_timeout
+        self.max_players = max_players
+
+    def get(self, guild_id):
+        # Players are created lazily on first use and kept in LRU order
+        player = self.players.get(guild_id)
+        if player is None:
+            player = GuildPlayer(guild_id, volume=default_volume)
+            self.players[guild_id] = player
+            self._enforce_limit()
+        else:
+            self.players.move_to_end(guild_id)
+        player.touch()
+        return player
+
+    def peek(self, guild_id):
+        return self.players.get(guild_id)
+
+    def remove(self, guild_id):
+        self.players.pop(guild_id, None)
+
+    def evict_idle(self):
+        evicted = 0
+        for guild_id, player in list(self.players.items()):
+            if player.is_idle(self._voice_client(guild_id), self.idle_timeout):
+                del self.players[guild_id]
+                evicted += 1
+        return evicted
+
+    def _enforce_limit(self):
+        # Drop the least recently used players that are not connected to voice
+        for guild_id in list(self.players.keys()):
+            if len(self.players) <= self.max_players:
+                return
+            if self._voice_client(guild_id) is None:
+                del self.players[guild_id]
+        if len(self.players) > self.max_players:
+            logging.warning(f"Player registry over limit: {len(self.players)} active players")
+
+    def _voice_client(self, guild_id):
+        guild = bot.get_guild(guild_id)
+        return guild.voice_client if guild else None
+
+    def __len__(self):
+        return len(self.players)
+
+class StateStore:
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS player_snapshots (
+                guild_id INTEGER PRIMARY KEY,
+                voice_channel_id INTEGER,
+                text_channel_id INTEGER,
+                volume REAL,
+                stream_url TEXT,
+                position REAL,
+                tracks TEXT,
+                saved_at REAL
+            )""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS play_counts (
+                track_key TEXT PRIMARY KEY,
+                plays INTEGER NOT NULL,
+                last_played REAL
+            )""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS track_loudness (
+                track_key TEXT PRIMARY KEY,
+                lufs REAL NOT NULL,
+                measured_at REAL
+            )""")
+
+    def save_snapshots(self, rows):
+        # The whole playback state is small, so each snapshot replaces the last in one transaction
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM player_snapshots")
+            self.db.executemany("INSERT INTO player_snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def count_play(self, track_key):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO play_counts VALUES (?, 1, ?) "
+                "ON CONFLICT(track_key) DO UPDATE SET plays = plays + 1, last_played = excluded.last_played",
+                (track_key, time.time()))
+            return self.db.execute("SELECT plays FROM play_counts WHERE track_key = ?", (track_key,)).fetchone()[0]
+
+    def save_loudness(self, track_key, lufs):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO track_loudness VALUES (?, ?, ?)", (track_key, lufs, time.time()))
+
+    def load_loudness(self):
+        with self.lock:
+            return self.db.execute("SELECT track_key, lufs FROM track_loudness").fetchall()
+
+    def load_snapshots(self):
+        with self.lock:
+            return self.db.execute(
+                "SELECT guild_id, voice_channel_id, text_channel_id, volume, stream_url, position, tracks "
+                "FROM player_snapshots").fetchall()
+
+    def close(self):
+        if self.db:
+            with self.lock:
+                self.db.close()
+            self.db = None
+
+state_store = StateStore(config.get("state_db", "pirate_state.db"))
+
+# Initialize bot
+intents = discord.Intents.default()
+intents.guilds = True
+intents.voice_states = True
+intents.message_content = True
+intents.members = True  # Add members intent to get Member objects
+
+# One pooled HTTP session for the whole process, opened in setup_hook and closed in close
+http_session = None
+
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit=config.get("http_pool_size", 100),
+        limit_per_host=config.get("http_per_host_limit", 10),
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=30))
+
+class PirateFMBot(commands.Bot):
+    async def setup_hook(self):
+        global http_session
+        http_session = create_http_session()
+        if loop_watchdog.threshold > 0:
+            loop_watchdog.start()
+        if command_profiler:
+            command_profiler.start()
+        if audio_workers.enabled:
+            audio_workers.start()
+        state_store.open()
+        await asyncio.to_thread(audio_cache.load)
+        await asyncio.to_thread(loudness.load)
+        if config.get("metrics_port"):
+            await metrics.start_server(config.get("metrics_host", "127.0.0.1"), config["metrics_port"])
+        # systemd stops the service with SIGTERM, make that a clean shutdown with a final snapshot
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.close()))
+        except NotImplementedError:
+            pass
+
+    async def close(self):
+        if state_store.db:
+            try:
+                state_store.save_snapshots(collect_snapshots())
+            except Exception as e:
+                logging.error(f"Error saving player snapshot: {e}")
+            state_store.close()
+        loop_watchdog.stop()
+        audio_workers.shutdown()
+        await metrics.stop_server()
+        await super().close()
+        if http_session and not http_session.closed:
+            await http_session.close()
+        extraction_pool.shutdown()
+
+bot = PirateFMBot(command_prefix='!', intents=intents)
+
+# Opt-in profiling of slow commands
+@bot.before_invoke
+async def profile_command_start(ctx):
+    if command_profiler:
+        command_profiler.begin(ctx)
+
+@bot.after_invoke
+async def profile_command_end(ctx):
+    if command_profiler:
+        command_profiler.end(ctx)
+
+# Global variables
+default_volume = 0.5
+crossfade_seconds = config.get("crossfade_seconds", 3)
+prefetch_depth = config.get("prefetch_depth", 2)
+auto_join_enabled = True
+players = PlayerRegistry(
+    idle_timeout=config.get("player_idle_timeout", 600),
+    max_players=config.get("max_players", 500),
+)
+
+# Helper function to safely get member voice state
+def get_member_voice(ctx):
+    """Safely get a member's voice state"""
+    if not ctx.guild:
+        return None, "This command can only be used in a server!"
+    
+    # Try multiple ways to get the member object
+    member = None
+    
+    # Method 1: If ctx.author is already a Member
+    if hasattr(ctx.author, 'voice'):
+        member = ctx.author
+    
+    # Method 2: Get member from guild
+    if not member:
+        member = ctx.guild.get_member(ctx.author.id)
+    
+    # Method 3: Fetch member if needed
+    if not member:
+        try:
+            # This is synchronous but should work
+            for m in ctx.guild.members:
+                if m.id == ctx.author.id:
+                    member = m
+                    break
+        except:
+            pass
+    
+    if not member:
+        return None, "Could not find you in this server! Try rejoining the server."
+    
+    if not hasattr(member, 'voice') or not member.voice or not member.voice.channel:
+        return None, "You need to be in a voice channel to use this command!"
+    
+    return member.voice.channel, None
+
+# Utility functions
+# url -> (fetched_at, etag, last_modified, data) for conditional status-json requests
+icecast_status_cache = {}
+
+async def fetch_icecast_status(url, max_age=10):
+    cached = icecast_status_cache.get(url)
+    if cached and time.monotonic() - cached[0] < max_age:
+        return cached[3]
+    
+    headers = {}
+    if cached:
+        if cached[1]:
+            headers['If-None-Match'] = cached[1]
+        if cached[2]:
+            headers['If-Modified-Since'] = cached[2]
+    try:
+        async with http_session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            if resp.status == 304 and cached:
+                icecast_status_cache[url] = (time.monotonic(),) + cached[1:]
+                return cached[3]
+            if resp.status == 200:
+                data = await resp.json(content_type=None)
+                icecast_status_cache[url] = (time.monotonic(), resp.headers.get('ETag'),
+                                             resp.headers.get('Last-Modified'), data)
+                return data
+            else:
+                logging.error(f"Failed to fetch data: {resp.status}")
+                return None
+    except Exception as e:
+        logging.error(f"Error fetching Icecast status: {e}")
+        return None
+
+class StreamHealth:
+    __slots__ = ('ok', 'status', 'error', 'checked_at')
+
+    def __init__(self, ok, status=None, error=None):
+        self.ok = ok
+        self.status = status
+        self.error = error
+        self.checked_at = time.monotonic()
+
+class StreamHealthRegistry:
+    def __init__(self, ttl=60, probe_bytes=4096):
+        self.entries = {}
+        self.ttl = ttl
+        self.probe_bytes = probe_bytes
+        self.probes = 0
+        self.skipped = 0
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        if entry and time.monotonic() - entry.checked_at < self.ttl:
+            return entry
+        return None
+
+    def mark(self, url, ok, status=None, error=None):
+        entry = StreamHealth(ok, status=status, error=error)
+        self.entries[url] = entry
+        return entry
+
+    async def probe(self, url, *, force=False, priority=PRIORITY_BACKGROUND):
+        entry = None if force else self.get(url)
+        if entry and entry.ok:
+            self.skipped += 1
+            return entry
+
+        self.probes += 1
+        try:
+            permit = await resource_governor.acquire(None, 'probe', priority)
+        except AdmissionTimeout as e:
+            # Says nothing about the stream itself, so it isn't recorded
+            return StreamHealth(False, error=str(e))
+        try:
+            async with http_session.get(url, headers={'Icy-MetaData': '0'}, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                if resp.status != 200:
+                    return self.mark(url, False, status=resp.status)
+                # Only confirm that audio starts flowing, then drop the connection
+                await resp.content.read(self.probe_bytes)
+                resp.close()
+                return self.mark(url, True, status=resp.status)
+        except asyncio.TimeoutError:
+            return self.mark(url, False, error="timed out")
+        except Exception as e:
+            return self.mark(url, False, error=str(e))
+        finally:
+            permit.release()
+
+    async def refresh_configured(self):
+        await asyncio.gather(*(self.probe(s['url'], force=True) for s in configured_streams))
+
+    def describe(self, url):
+        entry = self.entries.get(url)
+        if entry is None:
+            return "unknown"
+        age = int(time.monotonic() - entry.checked_at)
+        state = "healthy" if entry.ok else f"down ({entry.error or entry.status})"
+        return f"{state}, checked {age}s ago"
+
+stream_health = StreamHealthRegistry(ttl=config.get("stream_health_ttl", 60))
+
+ICY_TITLE_RE = re.compile(rb"StreamTitle='(.*?)';", re.DOTALL)
+
+class StreamTitles:
+    def __init__(self):
+        self.titles = {}
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def get(self, url):
+        return self.titles.get(url)
+
+    def publish(self, url, title):
+        if self.titles.get(url) == title:
+            return
+        self.titles[url] = title
+        for callback in self.listeners:
+            try:
+                callback(url, title)
+            except Exception as e:
+                logging.error(f"Stream title listener failed: {e}")
+
+stream_titles = StreamTitles()
+
+class IcyStream:
+    # File-like audio feed for ffmpeg's stdin that strips in-band ICY metadata
+    def __init__(self, url, max_reconnects=5):
+        self.url = url
+        self.max_reconnects = max_reconnects
+        self.chunks = queue.Queue(maxsize=64)
+        self.has_metadata = False
+        self.closed = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        failures = 0
+        while not self.closed and failures <= self.max_reconnects:
+            try:
+                async with http_session.get(self.url, headers={'Icy-MetaData': '1'},
+                                            timeout=aiohttp.ClientTimeout(total=None, sock_read=15)) as resp:
+                    if resp.status != 200:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                    metaint = int(resp.headers.get('icy-metaint', 0))
+                    self.has_metadata = metaint > 0
+                    failures = 0
+                    while not self.closed:
+                        if metaint:
+                            await self._push(await resp.content.readexactly(metaint))
+                            length = (await resp.content.readexactly(1))[0] * 16
+                            if length:
+                                self._parse_metadata(await resp.content.readexactly(length))
+                        else:
+                            chunk = await resp.content.read(8192)
+                            if not chunk:
+                                break
+                            await self._push(chunk)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.warning(f"Stream connection to {self.url} dropped: {e}")
+            # Reconnect with a short backoff, like ffmpeg's -reconnect flags did
+            failures += 1
+            if not self.closed and failures <= self.max_reconnects:
+                await asyncio.sleep(min(failures, 5))
+        self.closed = True
+        self._put(b'')
+
+    def _parse_metadata(self, block):
+        match = ICY_TITLE_RE.search(block)
+        if not match:
+            return
+        raw = match.group(1)
+        try:
+            title = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            title = raw.decode('latin-1')
+        if title.strip():
+            stream_titles.publish(self.url, title.strip())
+
+    async def _push(self, chunk):
+        while not self.closed:
+            try:
+                self.chunks.put_nowait(chunk)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    def _put(self, chunk):
+        try:
+            self.chunks.put_nowait(chunk)
+        except queue.Full:
+            pass
+
+    def read(self, size=-1):
+        # Called from ffmpeg's stdin writer thread
+        while True:
+            try:
+                return self.chunks.get(timeout=1)
+            except queue.Empty:
+                if self.closed:
+                    return b''
+
+    def close(self):
+        self.closed = True
+        if self.task:
+            self.task.cancel()
+        self._put(b'')
+
+class PacketRing:
+    """Encoded Opus packets in one preallocated arena, so each retained minute costs a fixed amount of memory"""
+    def __init__(self, frames, frame_bytes):
+        self.frames = frames
+        self.arena = bytearray(frames * frame_bytes)
+        self.view = memoryview(self.arena)
+        self.offsets = array('I', bytes(4 * frames))
+        self.lengths = array('H', bytes(2 * frames))
+        # Absolute packet indexes; everything in [tail, head) can be read back
+        self.head = 0
+        self.tail = 0
+        self.write_at = 0
+
+    def _overlaps(self, index, start, end):
+        offset = self.offsets[index % self.frames]
+        return offset < end and start < offset + self.lengths[index % self.frames]
+
+    def _evict(self, start, end):
+        # Packets are laid out in order, so the oldest ones are the first to be overwritten
+        while self.tail < self.head and (self.head - self.tail >= self.frames or self._overlaps(self.tail, start, end)):
+            self.tail += 1
+
+    def append(self, packet):
+        size = len(packet)
+        if self.write_at + size > len(self.arena):
+            # The gap left at the end of the arena is dropped along with what it still holds
+            self._evict(self.write_at, len(self.arena))
+            self.write_at = 0
+        start, end = self.write_at, self.write_at + size
+        self._evict(start, end)
+        slot = self.head % self.frames
+        self.offsets[slot] = start
+        self.lengths[slot] = size
+        self.view[start:end] = packet
+        self.write_at = end
+        self.head += 1
+
+    def get(self, index):
+        slot = index % self.frames
+        offset = self.offsets[slot]
+        return bytes(self.view[offset:offset + self.lengths[slot]])
+
+class BroadcastHub:
+    def __init__(self, url, volume, ring_size=250, start_lag=100, frame_bytes=400):
+        self.url = url
+        self.volume = volume
+        self.key = (url, volume)
+        self.ring = PacketRing(ring_size, frame_bytes)
+        self.ring_size = ring_size
+        self.start_lag = start_lag
+        # (packet index, title) where each stream title started, for !replay
+        self.titles = deque()
+        self.subscribers = 0
+        self.underruns = 0
+        self.eof = False
+        self.cond = threading.Condition()
+        self.feed = None
+        self.source = None
+        self.thread = None
+        self.permit = None
+        self.created_at = time.monotonic()
+        self.live_since = None
+        self.last_packet_at = None
+
+    def start(self):
+        # One upstream connection, read by us so ICY titles arrive in-band, and piped into ffmpeg
+        self.feed = IcyStream(self.url)
+        self.feed.start()
+        title = stream_titles.get(self.url)
+        if title:
+            self.mark_title(title)
+        # One ffmpeg decode and Opus encode for every guild listening to this URL
+        self.spawned_at = time.perf_counter()
+        self.source = discord.FFmpegOpusAudio(
+            self.feed,
+            pipe=True,
+            bitrate=config.get("stream_bitrate", 128),
+            # Flush an Ogg page per packet so a stalled upstream shows up within a frame, not a page
+            options=f'-vn -loglevel error -af volume={self.volume:.2f} -page_duration 20000',
+        )
+        metrics.track_ffmpeg(self.source)
+        self.thread = threading.Thread(target=self._run, name=f"hub-{self.url}", daemon=True)
+        self.thread.start()
+
+    @property
+    def head(self):
+        return self.ring.head
+
+    def _run(self):
+        try:
+            while True:
+                packet = self.source.read()
+                if not packet:
+                    break
+                if packet.startswith((b'OpusHead', b'OpusTags')):
+                    # Ogg stream headers, not audio
+                    continue
+                with self.cond:
+                    self.ring.append(packet)
+                    # Keep the mark of the title playing at the oldest buffered packet
+                    while len(self.titles) > 1 and self.titles[1][0] <= self.ring.tail:
+                        self.titles.popleft()
+                    self.cond.notify_all()
+                self.last_packet_at = time.monotonic()
+                if self.head == 1:
+                    self.live_since = self.last_packet_at
+                    stream_health.mark(self.url, True, status=200)
+                    metrics.first_frame.observe(time.perf_counter() - self.spawned_at, 'stream')
+        except Exception as e:
+            logging.error(f"Broadcast hub for {self.url} failed: {e}")
+        finally:
+            with self.cond:
+                self.eof = True
+                self.cond.notify_all()
+
+    def stop(self):
+        if self.feed:
+            self.feed.close()
+        if self.source:
+            self.source.cleanup()
+        if self.permit:
+            self.permit.release()
+
+    def start_cursor(self):
+        # Start behind the live edge by the prebuffer depth so upstream hiccups don't underrun
+        with self.cond:
+            return max(0, self.head - self.start_lag)
+
+    def oldest_cursor(self):
+        return self.ring.tail
+
+    def mark_title(self, title):
+        with self.cond:
+            self.titles.append((self.head, title))
+
+    def title_at(self, cursor):
+        # The title whose mark is the last one at or before the cursor
+        with self.cond:
+            marks = list(self.titles)
+        index = bisect.bisect_right([mark for mark, _ in marks], cursor) - 1
+        return marks[index] if index >= 0 else None
+
+    def read_packet(self, cursor, timeout=0.02):
+        with self.cond:
+            if cursor < self.ring.tail:
+                # Fell behind the buffer, carry on from the oldest packet still kept
+                cursor = self.ring.tail
+            if cursor >= self.head:
+                if self.eof:
+                    return None, cursor
+                self.cond.wait(timeout)
+                if cursor >= self.head:
+                    return OPUS_SILENCE, cursor
+            return self.ring.get(cursor), cursor + 1
+
+    def is_live(self):
+        return not self.eof and self.head > 0
+
+class HubSubscriber(discord.AudioSource):
+    def __init__(self, hub):
+        self.hub = hub
+        self.url = hub.url
+        # Subscriber on the hub for a new volume step, taken over by read() once it has buffered
+        self.next = None
+        self.lock = threading.Lock()
+        # Whether the last packet from the hub was digital silence
+        self.silent = False
+        self.cursor = hub.start_cursor()
+        # Set by !rewind and friends, picked up by the player thread on its next read
+        self.seek_cursor = None
+        self.primed = False
+        # Whether the last read was filler rather than a packet from the stream
+        self.padded = True
+        self.underruns = 0
+        self.closed = False
+        self.clock = FrameClock()
+        self.on_first_audio = None
+
+    def is_opus(self):
+        return True
+
+    @property
+    def volume(self):
+        pending = self.next
+        return (pending or self).hub.volume
+
+    @volume.setter
+    def volume(self, value):
+        # Hubs are encoded per volume step; keep playing this one until the new step's hub has buffered
+        level = broadcast_hubs.level(value)
+        pending = self.next
+        if level == self.hub.volume:
+            new = None
+        elif pending is not None and pending.hub.volume == level:
+            return
+        else:
+            new = broadcast_hubs.subscribe(self.url, value)
+        with self.lock:
+            if self.closed:
+                pending = new
+            else:
+                pending, self.next = self.next, new
+        if pending is not None:
+            pending.cleanup()
+
+    def _take_over(self):
+        with self.lock:
+            pending = self.next
+            if pending is None or not (pending.hub.eof or self.hub.eof or pending.fill() >= pending.hub.start_lag):
+                return
+            self.next = None
+            if not pending.hub.eof:
+                # Stay as far behind live as before, as far back as the new hub's buffer reaches
+                behind = self.hub.head - self.cursor
+                self.hub, pending.hub = pending.hub, self.hub
+                self.cursor = max(self.hub.head - behind, self.hub.oldest_cursor())
+        # Releases whichever hub is no longer played: the old step's, or the new one if it failed to start
+        pending.cleanup()
+
+    def fill(self):
+        return self.hub.head - self.cursor
+
+    def behind_live(self):
+        # Seconds behind the normal listening position, 0 when not time-shifted
+        cursor = self.cursor if self.seek_cursor is None else self.seek_cursor
+        return max(self.hub.head - self.hub.start_lag - cursor, 0) / 50
+
+    def seek(self, cursor):
+        self.seek_cursor = min(max(cursor, self.hub.oldest_cursor()), self.hub.start_cursor())
+        return self.seek_cursor
+
+    def read(self):
+        self.clock.tick()
+        if self.seek_cursor is not None:
+            self.cursor, self.seek_cursor = self.seek_cursor, None
+        if self.next is not None:
+            self._take_over()
+        if not self.primed:
+            # A fresh hub has nothing buffered yet, wait for the prebuffer depth
+            if self.fill() < self.hub.start_lag and not self.hub.eof:
+                self.padded = True
+                return OPUS_SILENCE
+            self.primed = True
+        packet, self.cursor = self.hub.read_packet(self.cursor)
+        self.padded = packet is OPUS_SILENCE
+        if packet is OPUS_SILENCE:
+            self.underruns += 1
+            self.hub.underruns += 1
+            return packet
+        if not packet:
+            return b''
+        self.silent = len(packet) <= SILENT_OPUS_BYTES
+        if self.on_first_audio:
+            self.on_first_audio()
+            self.on_first_audio = None
+        return packet
+
+    def stats(self):
+        shifted = f", {self.behind_live():.0f}s behind live" if self.behind_live() >= 1 else ""
+        return (f"buffer {max(self.fill(), 0) / 50:.1f}s/{self.hub.ring_size / 50:.1f}s{shifted}, "
+                f"{self.underruns} underrun frames")
+
+    def cleanup(self):
+        with self.lock:
+            pending, self.next = self.next, None
+            closing = not self.closed
+            self.closed = True
+        if pending is not None:
+            pending.cleanup()
+        if closing:
+            broadcast_hubs.unsubscribe(self.hub)
+
+class BroadcastRegistry:
+    def __init__(self, ring_seconds=5, bitrate=128, volume_step=0.1):
+        self.hubs = {}
+        # Volumes are rounded to steps, so guilds at similar volumes share a hub and its ffmpeg
+        self.volume_step = volume_step
+        self.ring_size = int(ring_seconds * 50)
+        # Room for a 20 ms packet at the stream bitrate, with headroom for VBR peaks
+        self.frame_bytes = int(bitrate * 1000 / 8 / 50 * 1.25)
+        self.lock = threading.Lock()
+
+    def level(self, volume):
+        volume = max(volume, 0.0)
+        if self.volume_step > 0:
+            volume = round(volume / self.volume_step) * self.volume_step
+        return round(volume, 2)
+
+    def needs_hub(self, url, volume):
+        hub = self.hubs.get((url, self.level(volume)))
+        return hub is None or hub.eof
+
+    def has_icy_titles(self, url):
+        # The hub's own upstream connection carries in-band titles, no status-json needed
+        return any(hub.url == url and hub.feed is not None and hub.feed.has_metadata
+                   for hub in list(self.hubs.values()))
+
+    def subscribe(self, url, volume, permit=None):
+        # Hubs are shared per URL and volume step
+        level = self.level(volume)
+        with self.lock:
+            hub = self.hubs.get((url, level))
+            if hub is None or hub.eof:
+                prebuffer = int(stream_prebuffer(url) * 50)
+                hub = BroadcastHub(url, level, ring_size=max(self.ring_size, prebuffer + 50), start_lag=prebuffer,
+                                   frame_bytes=self.frame_bytes)
+                hub.start()
+                # Every hub is accounted for, callers that can wait have already been admitted
+                hub.permit = permit or resource_governor.acquire_now(None, 'stream')
+                self.hubs[hub.key] = hub
+            elif permit:
+                # Someone else started this hub while we were queued
+                permit.release()
+            hub.subscribers += 1
+        return HubSubscriber(hub)
+
+    def unsubscribe(self, hub):
+        with self.lock:
+            hub.subscribers -= 1
+            if hub.subscribers > 0:
+                return
+            if self.hubs.get(hub.key) is hub:
+                del self.hubs[hub.key]
+        # Last listener left, tear down the upstream connection and ffmpeg
+        hub.stop()
+
+    def mark_title(self, url, title):
+        for hub in list(self.hubs.values()):
+            if hub.url == url:
+                hub.mark_title(title)
+
+    def is_live(self, url):
+        return any(hub.url == url and hub.is_live() for hub in list(self.hubs.values()))
+
+    def stats(self):
+        listeners = sum(hub.subscribers for hub in self.hubs.values())
+        underruns = sum(hub.underruns for hub in self.hubs.values())
+        memory = sum(len(hub.ring.arena) for hub in self.hubs.values())
+        return (f"{len(self.hubs)} hub(s), {listeners} listener(s), {underruns} underrun frames, "
+                f"{memory / 2**20:.1f} MB time-shift buffers")
+
+broadcast_hubs = BroadcastRegistry(
+    ring_seconds=max(config.get("broadcast_buffer_seconds", 5), config.get("timeshift_minutes", 10) * 60),
+    bitrate=config.get("stream_bitrate", 128),
+    volume_step=config.get("stream_volume_step", 10) / 100,
+)
+
+async def admit_stream(url, volume, on_queued=None):
+    # Joining a running hub is free, only a new upstream connection and ffmpeg need a slot
+    if not broadcast_hubs.needs_hub(url, volume):
+        return None
+    return await resource_governor.acquire(None, 'stream', on_queued=on_queued)
+
+def stream_group(url):
+    # Configured streams form one failover group: the chosen stream first, then the rest in config order
+    urls = [stream['url'] for stream in configured_streams]
+    if url not in urls:
+        return [url]
+    return [url] + [u for u in urls if u != url]
+
+def find_stream(name):
+    for stream in configured_streams:
+        if stream['name'].lower() == name.strip().lower():
+            return stream['url']
+    return None
+
+class FailoverSource(discord.AudioSource):
+    """Plays a stream group, keeping the next candidate connected and buffered as a hot standby"""
+    def __init__(self, urls, volume, *, start_url=None, timeout=1.0, silence=3.0, recover=10.0, retry=30.0,
+                 on_switch=None, permit=None):
+        self.urls = urls
+        self._volume = volume
+        self.timeout = timeout
+        self.silence_limit = int(silence * 50) if silence else None
+        self.recover = recover
+        self.retry = retry
+        self.on_switch = on_switch
+        self.lock = threading.Lock()
+        self.active = broadcast_hubs.subscribe(start_url or urls[0], volume, permit)
+        self.standby = None
+        # url -> when it last failed, so dead streams are only retried every so often
+        self.failed = {}
+        self.silent_run = 0
+        self.switches = 0
+        self.on_first_audio = None
+        self.closed = False
+        self.loop = asyncio.get_running_loop()
+        self.task = self.loop.create_task(self._supervise())
+
+    @property
+    def url(self):
+        return self.active.url
+
+    def is_opus(self):
+        return True
 
-class YTDLSource(PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume=volume)
-        self.data = data
-        self.title = data.get('title')
-        self.url = data.get('url')
-        self.duration = data.get('duration')
-        self.uploader = data.get('uploader')
+    def _failure(self, subscriber):
+        hub = subscriber.hub
+        now = time.monotonic()
+        if hub.eof:
+            return "ended"
+        if hub.last_packet_at is None:
+            # Still connecting; a stream that never produces audio counts as down
+            return "not responding" if now - hub.created_at > max(5.0, self.timeout) else None
+        if now - hub.last_packet_at > self.timeout:
+            return "stalled"
+        return None
 
-    @classmethod
-    async def create_source(cls, search: str, *, loop=None, volume=0.5):
-        loop = loop or asyncio.get_event_loop()
-        
-        try:
-            # Extract info from YouTube
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(search, download=False))
-            
-            if 'entries' in data:
-                # Take first item from a playlist
-                data = data['entries'][0]
-            
-            # Get the direct URL for streaming
-            url = data['url']
-            source = discord.FFmpegPCMAudio(url, **ffmpeg_options)
-            return cls(source, data=data, volume=volume)
-        except Exception as e:
-            logging.error(f"Error creating YouTube source: {e}")
-            return None
+    def _usable(self, subscriber):
+        return subscriber is not None and subscriber.hub.is_live() and self._failure(subscriber) is None
 
-class MusicQueue:
-    def __init__(self):
-        self.queue = deque()
-        self.current_track = None
-        self.repeat_mode = False
-        self.shuffle_mode = False
+    def read(self):
+        with self.lock:
+            reason = self._failure(self.active)
+            if reason is None and self.silence_limit and self.silent_run >= self.silence_limit:
+                reason = "silent"
+            if reason and self._usable(self.standby):
+                self._switch(reason)
+            active = self.active
+        packet = active.read()
+        if not packet:
+            # Keep the voice connection alive while the supervisor finds a working stream
+            return OPUS_SILENCE
+        if active.padded or not active.hub.is_live():
+            # Connecting, prebuffering and underruns are padding, stalls are caught by _failure
+            return packet
+        if active.silent:
+            self.silent_run += 1
+        else:
+            self.silent_run = 0
+            if self.on_first_audio:
+                self.on_first_audio()
+                self.on_first_audio = None
+        return packet
 
-    def add_track(self, track_info):
-        self.queue.append(track_info)
+    def _switch(self, reason):
+        # Called with the lock held, from the player thread or the event loop
+        old, new = self.active, self.standby
+        # Join the standby behind its live edge by the prebuffer depth, already buffered
+        new.cursor = new.hub.start_cursor()
+        new.primed = True
+        self.active, self.standby = new, None
+        self.silent_run = 0
+        self.switches += 1
+        if reason != "recovered":
+            self.failed[old.url] = time.monotonic()
+        self.loop.call_soon_threadsafe(self._switched, old, reason)
 
-    def add_playlist(self, playlist_tracks):
-        self.queue.extend(playlist_tracks)
+    def _switched(self, old, reason):
+        old.cleanup()
+        if reason == "recovered":
+            logging.info(f"Stream {stream_label(self.url)} is back, switched from {stream_label(old.url)}")
+        else:
+            logging.warning(f"Stream {stream_label(old.url)} {reason}, switched to {stream_label(self.url)}")
+            stream_health.mark(old.url, False, error=reason)
+        if self.on_switch:
+            self.on_switch(self.url)
 
-    def get_next_track(self):
-        if self.repeat_mode and self.current_track:
-            return self.current_track
-        
-        if self.queue:
-            self.current_track = self.queue.popleft()
-            return self.current_track
+    def _wanted_standby(self):
+        # The most preferred stream that isn't playing and hasn't failed recently
+        now = time.monotonic()
+        for url in self.urls:
+            if url != self.active.url and now - self.failed.get(url, -self.retry) >= self.retry:
+                return url
         return None
 
-    def skip_track(self):
-        if self.queue:
-            self.current_track = self.queue.popleft()
-            return self.current_track
-        return None
+    async def _supervise(self):
+        while not self.closed:
+            await asyncio.sleep(0.25)
+            try:
+                self._arrange_standby()
+            except Exception as e:
+                logging.error(f"Stream failover error: {e}")
 
-    def clear(self):
-        self.queue.clear()
-        self.current_track = None
+    def _arrange_standby(self):
+        standby = self.standby
+        failure = self._failure(standby) if standby is not None else None
+        if failure:
+            self.failed[standby.url] = time.monotonic()
+            stream_health.mark(standby.url, False, error=failure)
+        if standby is not None and (failure or standby.url != self._wanted_standby()):
+            with self.lock:
+                if self.standby is standby:
+                    self.standby = None
+            standby.cleanup()
+            standby = None
 
-    def get_queue_info(self):
-        return list(self.queue)
+        wanted = self._wanted_standby()
+        if standby is None and wanted is not None:
+            permit = None
+            if broadcast_hubs.needs_hub(wanted, self.volume):
+                # Standbys only use spare capacity, the next tick tries again
+                permit = resource_governor.try_acquire(None, 'stream', PRIORITY_STANDBY)
+                if permit is None:
+                    return
+            subscriber = broadcast_hubs.subscribe(wanted, self.volume, permit)
+            with self.lock:
+                self.standby = subscriber
+            return
 
-    def is_empty(self):
-        return len(self.queue) == 0 and self.current_track is None
+        # Go back to a more preferred stream once it has been stable for a while
+        if standby is not None and self.urls.index(standby.url) < self.urls.index(self.active.url):
+            live_since = standby.hub.live_since
+            if self._usable(standby) and live_since and time.monotonic() - live_since >= self.recover:
+                with self.lock:
+                    if self.standby is standby:
+                        self._switch("recovered")
 
-# Initialize bot
-intents = discord.Intents.default()
-intents.guilds = True
-intents.voice_states = True
-intents.message_content = True
-intents.members = True  # Add members intent to get Member objects
+    @property
+    def volume(self):
+        return self._volume
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        with self.lock:
+            subscribers = (self.active, self.standby)
+        for subscriber in subscribers:
+            if subscriber is not None:
+                subscriber.volume = value
 
-# Global variables
-music_queue = MusicQueue()
-default_volume = 0.5
-current_source = None
-is_playing_stream = False
-auto_join_enabled = True
+    def stats(self):
+        standby = stream_label(self.standby.url) if self.standby else "none"
+        return (f"{stream_label(self.url)} (standby {standby}), {self.switches} failovers, "
+                f"{self.active.stats()}")
 
-# Helper function to safely get member voice state
-def get_member_voice(ctx):
-    """Safely get a member's voice state"""
-    if not ctx.guild:
-        return None, "This command can only be used in a server!"
-    
-    # Try multiple ways to get the member object
-    member = None
-    
-    # Method 1: If ctx.author is already a Member
-    if hasattr(ctx.author, 'voice'):
-        member = ctx.author
-    
-    # Method 2: Get member from guild
-    if not member:
-        member = ctx.guild.get_member(ctx.author.id)
-    
-    # Method 3: Fetch member if needed
-    if not member:
-        try:
-            # This is synchronous but should work
-            for m in ctx.guild.members:
-                if m.id == ctx.author.id:
-                    member = m
-                    break
-        except:
-            pass
-    
-    if not member:
-        return None, "Could not find you in this server! Try rejoining the server."
-    
-    if not hasattr(member, 'voice') or not member.voice or not member.voice.channel:
-        return None, "You need to be in a voice channel to use this command!"
-    
-    return member.voice.channel, None
+    def cleanup(self):
+        # Called from the player thread; hubs and tasks belong to the event loop
+        if not self.closed:
+            self.closed = True
+            self.loop.call_soon_threadsafe(self._close)
 
-# Utility functions
-async def fetch_icecast_status(url):
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data
-                else:
-                    logging.error(f"Failed to fetch data: {resp.status}")
-                    return None
-    except Exception as e:
-        logging.error(f"Error fetching Icecast status: {e}")
-        return None
+    def _close(self):
+        self.task.cancel()
+        with self.lock:
+            subscribers = (self.active, self.standby)
+        for subscriber in subscribers:
+            if subscriber is not None:
+                subscriber.cleanup()
+
+def open_stream(player, stream_url, start_url=None, permit=None):
+    """Subscribe a player to a stream, with failover when it belongs to the configured group"""
+    urls = stream_group(stream_url)
+    if len(urls) == 1:
+        return broadcast_hubs.subscribe(stream_url, player.volume, permit)
+
+    def on_switch(url):
+        player.stream_url = url
+        if player.now_playing_channel:
+            title = stream_titles.get(url)
+            text = f"🔴 Now streaming: **{stream_label(url)}**"
+            update_bus.now_playing(player, player.now_playing_channel, f"{text}\n🎵 {title}" if title else text)
+        update_bus.request_presence()
+
+    return FailoverSource(
+        urls, player.volume, start_url=start_url,
+        timeout=config.get("failover_timeout", 1.0),
+        silence=config.get("failover_silence", 3.0),
+        recover=config.get("failover_recover", 10),
+        on_switch=on_switch,
+        permit=permit,
+    )
+
+def stream_subscriber(source):
+    # The hub subscriber a guild is listening through, also inside a failover group
+    if isinstance(source, FailoverSource):
+        return source.active
+    return source if isinstance(source, HubSubscriber) else None
+
+def parse_offset(text):
+    # "90", "90s", "2m" or "1:30"
+    text = text.strip().lower()
+    if ':' in text:
+        minutes, seconds = text.split(':', 1)
+        return int(minutes) * 60 + float(seconds)
+    if text.endswith('m'):
+        return float(text[:-1]) * 60
+    return float(text.rstrip('s'))
+
+def format_offset(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
 
 async def get_now_playing():
     status_data = await fetch_icecast_status(icecast_status_url)
@@ -210,122 +3049,310 @@ async def get_now_playing():
     else:
         return "Unknown"
 
-async def update_status_task():
-    global is_playing_stream, music_queue
-    current_status = None
+def stream_label(url):
+    for stream in configured_streams:
+        if stream['url'] == url:
+            return stream['name']
+    return url
+
+async def presence_text():
+    # Presence is bot-wide, so it reflects the configured home guild
+    player = players.peek(int(config["guild_id"]))
+    if player and player.is_playing_stream:
+        # Prefer the in-band ICY title, fall back to polling status-json
+        now_playing = stream_titles.get(player.stream_url) or await get_now_playing()
+        return f"🎵 {now_playing}"
+    elif player and player.queue.current_track:
+        return f"🎵 {player.queue.current_track.title}"
+    return "Ready for music!"
+
+class UpdateBus:
+    def __init__(self, debounce=1.5, presence_interval=15):
+        self.debounce = debounce
+        self.presence_interval = presence_interval
+        self.presence_event = asyncio.Event()
+        self.message_event = asyncio.Event()
+        self.presence_sent = None
+        self.presence_sent_at = 0
+        self.pending_messages = {}
+        self.requested = 0
+        self.api_calls = 0
+        self.tasks = []
+
+    def start(self):
+        if not self.tasks:
+            loop = asyncio.get_running_loop()
+            self.tasks = [loop.create_task(self._run_presence()), loop.create_task(self._run_messages())]
+
+    def request_presence(self):
+        self.requested += 1
+        self.presence_event.set()
+
+    def now_playing(self, player, channel, text):
+        # Only the latest text per guild is kept; it edits that guild's now-playing message
+        self.requested += 1
+        self.pending_messages[player.guild_id] = (player, channel, text)
+        self.message_event.set()
+        self.request_presence()
+
+    async def _run_presence(self):
+        while True:
+            await self.presence_event.wait()
+            # Let bursts such as fast skips settle into a single update
+            await asyncio.sleep(self.debounce)
+            wait = self.presence_interval - (time.monotonic() - self.presence_sent_at)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.presence_event.clear()
+            try:
+                text = await presence_text()
+                if text != self.presence_sent:
+                    await bot.change_presence(activity=discord.Game(name=text))
+                    self.api_calls += 1
+                    self.presence_sent = text
+                    self.presence_sent_at = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error updating status: {e}")
+
+    async def _run_messages(self):
+        while True:
+            await self.message_event.wait()
+            await asyncio.sleep(self.debounce)
+            self.message_event.clear()
+            pending, self.pending_messages = self.pending_messages, {}
+            for player, channel, text in pending.values():
+                try:
+                    await self._update_message(player, channel, text)
+                except Exception as e:
+                    logging.error(f"Error updating now playing message: {e}")
+
+    async def _update_message(self, player, channel, text):
+        if channel is None:
+            return
+        self.api_calls += 1
+        message = player.now_playing_message
+        if message is not None and message.channel.id == channel.id:
+            try:
+                await message.edit(content=text)
+                return
+            except discord.NotFound:
+                pass
+        player.now_playing_message = await channel.send(text)
+
+    def stats(self):
+        saved = max(self.requested - self.api_calls, 0)
+        return f"{self.requested} updates, {self.api_calls} API calls, {saved} saved"
+
+update_bus = UpdateBus(
+    debounce=config.get("update_debounce", 1.5),
+    presence_interval=config.get("presence_interval", 15),
+)
+
+def on_stream_title(url, title):
+    broadcast_hubs.mark_title(url, title)
+    for player in list(players.players.values()):
+        subscriber = stream_subscriber(player.current_source)
+        if subscriber is not None and subscriber.behind_live() >= 1:
+            # Rewound listeners are still hearing an earlier song
+            continue
+        if player.is_playing_stream and player.stream_url == url and player.now_playing_channel:
+            update_bus.now_playing(player, player.now_playing_channel,
+                                   f"🔴 Now streaming: **{stream_label(url)}**\n🎵 {title}")
+    update_bus.request_presence()
+
+stream_titles.subscribe(on_stream_title)
+
+async def status_poll_task():
+    # Fallback for streams without in-band ICY titles: status-json is polled instead
+    while True:
+        await asyncio.sleep(30)
+        player = players.peek(int(config["guild_id"]))
+        if (player and player.is_playing_stream and stream_titles.get(player.stream_url) is None
+                and not broadcast_hubs.has_icy_titles(player.stream_url)):
+            update_bus.request_presence()
+
+async def player_eviction_task():
     while True:
+        await asyncio.sleep(60)
         try:
-            if is_playing_stream:
-                now_playing = await get_now_playing()
-                status_text = f"🎵 {now_playing}"
-            elif music_queue.current_track:
-                track = music_queue.current_track
-                status_text = f"🎵 {track['title']}"
-            else:
-                status_text = "Ready for music!"
-            
-            if status_text != current_status:
-                await bot.change_presence(activity=discord.Game(name=status_text))
-                current_status = status_text
-                
-            await asyncio.sleep(30)
+            evicted = players.evict_idle()
+            if evicted:
+                logging.info(f"Evicted {evicted} idle guild player(s), {len(players)} remaining")
         except Exception as e:
-            logging.error(f"Error updating status: {e}")
-            await asyncio.sleep(60)
+            logging.error(f"Error evicting idle players: {e}")
 
 async def play_next(ctx):
-    global music_queue, default_volume
+    player = players.get(ctx.guild.id)
+    music_queue = player.queue
     next_track = music_queue.get_next_track()
     
     if next_track:
-        if next_track['type'] == 'youtube':
-            # Create source for this track if it doesn't exist
-            if not next_track.get('source'):
-                source = await YTDLSource.create_source(next_track['url'], volume=default_volume)
-                next_track['source'] = source
-            else:
-                source = next_track['source']
+        if next_track.kind == 'youtube':
+            # Restored tracks resume at their saved offset
+            start, player.pending_offset = player.pending_offset, 0
+            
+            async def on_queued(position):
+                await ctx.send(f"⏳ The bot is busy, **{next_track.title}** is waiting for a free audio slot "
+                               f"(#{position} in line)...")
+            
+            # The ffmpeg source is only created now, right before playback
+            source = await YTDLSource.create_source(next_track.url, guild_id=ctx.guild.id, volume=player.volume,
+                                                    bitrate=ctx.voice_client.channel.bitrate, start=start,
+                                                    on_queued=on_queued)
+            
+            if source and ctx.voice_client is None:
+                # Stopped or left the channel while the track was prebuffering
+                source.cleanup()
+                return
             
             if source:
+                player.track_offset = start
+                player.watch_first_audio(source)
                 # Update current track in the queue
                 music_queue.current_track = next_track
+                player.current_source = source
                 
-                def after_playing(error):
-                    if error:
-                        logging.error(f'Player error: {error}')
-                    asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
-                
-                ctx.voice_client.play(source, after=after_playing)
-                await ctx.send(f"🎵 Now playing: **{next_track['title']}**")
+                try:
+                    if source.is_opus():
+                        def after_playing(error):
+                            if error:
+                                logging.error(f'Player error: {error}')
+                            asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+                        
+                        ctx.voice_client.play(source, after=after_playing)
+                    else:
+                        # The source is seeked with -ss, only the rest of the track is left to play
+                        remaining = next_track.duration - start if next_track.duration else None
+                        await play_mixed(ctx, player, source, remaining)
+                except Exception as e:
+                    # Release the ffmpeg process and its governor permit, or the guild's slots leak
+                    logging.error(f"Error starting playback of {next_track.title}: {e}")
+                    source.cleanup()
+                    music_queue.current_track = None
+                    player.current_source = None
+                    return
+                player.schedule_prefetch()
+                player.now_playing_channel = ctx.channel
+                update_bus.now_playing(player, ctx.channel, f"🎵 Now playing: **{next_track.title}**")
             else:
-                await ctx.send(f"❌ Failed to play: **{next_track['title']}**, skipping...")
+                await ctx.send(f"❌ Failed to play: **{next_track.title}**, skipping...")
                 await play_next(ctx)
-        elif next_track['type'] == 'icecast':
-            await play_icecast_stream(ctx, next_track['url'])
+        elif next_track.kind == 'icecast':
+            await play_icecast_stream(ctx, next_track.url)
     else:
+        if player.mixer and not player.mixer.ended and player.mixer.finish():
+            # Early signal before a crossfade; the mixer calls again once the last track really ends
+            return
         # Queue is empty, clear current track
         music_queue.current_track = None
+        update_bus.request_presence()
         await ctx.send("📭 Queue finished! Use `!play <song>` to add more music.")
 
+async def play_mixed(ctx, player, source, duration):
+    # PCM tracks go through one long-lived mixer per guild, so track changes crossfade
+    mixer = player.mixer
+    if mixer is not None and not mixer.ended and ctx.voice_client.source is mixer:
+        mixer.crossfade_to(source, duration)
+        return
+    
+    # Let a mixer that just ran out release the voice client first
+    for _ in range(20):
+        if not ctx.voice_client.is_playing():
+            break
+        await asyncio.sleep(0.05)
+    
+    def on_track_end():
+        asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+    
+    options = dict(volume=player.volume, crossfade=crossfade_seconds, on_track_end=on_track_end,
+                   idle_timeout=extraction_pool.timeout + 5)
+    if audio_workers.enabled:
+        # Mixing and Opus encoding happen in an audio worker, only packets come back here
+        mixer = RemoteMixer(audio_workers, **options)
+    else:
+        mixer = PCMMixer(**options)
+    mixer.crossfade_to(source, duration)
+    try:
+        ctx.voice_client.play(mixer, after=lambda e: logging.error(f'Player error: {e}') if e else None)
+    except Exception:
+        # Never reached the voice client, so nothing else would clean it up
+        mixer.cleanup()
+        raise
+    player.mixer = mixer
+
 async def handle_playlist(ctx, playlist_url):
-    global music_queue
+    player = players.get(ctx.guild.id)
+    limit = config.get("max_playlist_size", 50)
+    added = 0
     try:
-        # Extract playlist info
-        data = await bot.loop.run_in_executor(None, lambda: ytdl.extract_info(playlist_url, download=False))
-        
-        if 'entries' in data:
-            playlist_title = data.get('title', 'Unknown Playlist')
-            entries = data['entries'][:50]  # Limit to 50 tracks
+        # Entries arrive one by one, so the first track can start before the listing finishes
+        async for kind, item in extraction_pool.stream_playlist(playlist_url, limit=limit, guild_id=ctx.guild.id):
+            if kind == 'playlist':
+                await ctx.send(f"Adding playlist: **{item}** (up to {limit} tracks)")
+                continue
             
-            await ctx.send(f"Adding playlist: **{playlist_title}** ({len(entries)} tracks)")
+            if not ctx.voice_client:
+                # Disconnected while the playlist was loading
+                break
             
-            for entry in entries:
-                if entry:
-                    track_info = {
-                        'type': 'youtube',
-                        'title': entry.get('title', 'Unknown'),
-                        'url': entry.get('webpage_url', ''),
-                        'duration': entry.get('duration'),
-                        'uploader': entry.get('uploader', 'Unknown'),
-                        'source': None
-                    }
-                    music_queue.add_track(track_info)
+            player.queue.add_track(Track.from_info(item, url=item.get('url')))
+            added += 1
             
             # Start playing if nothing is currently playing
-            if not ctx.voice_client.is_playing():
+            if not (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
                 await play_next(ctx)
+            else:
+                player.schedule_prefetch()
+        
+        await ctx.send(f"✅ Added **{added}** tracks from the playlist")
                 
     except Exception as e:
         await ctx.send(f"Error loading playlist: {str(e)}")
 
 async def play_icecast_stream(ctx, stream_url):
-    global default_volume, is_playing_stream, current_source
+    player = players.get(ctx.guild.id)
     try:
         await ctx.send(f"🔄 Connecting to stream: **{stream_url}**")
         
-        # Test the stream URL first
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(stream_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                    if response.status != 200:
-                        await ctx.send(f"❌ Stream not accessible. Status: {response.status}")
-                        return
-            except asyncio.TimeoutError:
+        # Test the stream URL first, unless it is already live or was recently seen healthy
+        health = (None if broadcast_hubs.is_live(stream_url)
+                  else await stream_health.probe(stream_url, priority=PRIORITY_PLAYBACK))
+        start_url = None
+        if health and not health.ok:
+            # Start on the next working stream of the group, failover moves back once this one recovers
+            for candidate in stream_group(stream_url)[1:]:
+                if (broadcast_hubs.is_live(candidate)
+                        or (await stream_health.probe(candidate, priority=PRIORITY_PLAYBACK)).ok):
+                    start_url = candidate
+                    break
+        if start_url:
+            await ctx.send(f"⚠️ **{stream_label(stream_url)}** is not responding, "
+                           f"playing **{stream_label(start_url)}** until it is back")
+        elif health and not health.ok:
+            if health.error == "timed out":
                 await ctx.send("❌ Stream connection timed out. The stream might be offline.")
-                return
-            except Exception as e:
-                await ctx.send(f"❌ Stream test failed: {str(e)}")
-                return
+            elif health.error:
+                await ctx.send(f"❌ Stream test failed: {health.error}")
+            else:
+                await ctx.send(f"❌ Stream not accessible. Status: {health.status}")
+            return
+        
+        async def on_queued(position):
+            await ctx.send(f"⏳ The bot is busy, waiting for a free stream slot (#{position} in line)...")
+        
+        try:
+            permit = await admit_stream(start_url or stream_url, player.volume, on_queued)
+        except AdmissionTimeout:
+            await ctx.send("❌ Too many streams are playing right now, try again in a moment.")
+            return
         
-        # Create the audio source with better error handling
+        # Subscribe to the shared broadcast for this stream with better error handling
         try:
-            audio_source = FFmpegPCMAudio(
-                stream_url, 
-                before_options='-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-                options='-vn -loglevel error'
-            )
-            audio_source = PCMVolumeTransformer(audio_source, volume=default_volume)
+            audio_source = open_stream(player, stream_url, start_url, permit)
+            player.watch_first_audio(audio_source)
         except Exception as e:
+            if permit:
+                permit.release()
             await ctx.send(f"❌ Failed to create audio source: {str(e)}")
             logging.error(f"Audio source creation error: {e}")
             return
@@ -333,11 +3360,16 @@ async def play_icecast_stream(ctx, stream_url):
         # Play the stream
         try:
             ctx.voice_client.play(audio_source, after=lambda e: logging.error(f'Stream error: {e}') if e else None)
-            is_playing_stream = True
-            current_source = audio_source
+            player.is_playing_stream = True
+            player.stream_url = audio_source.url
+            player.current_source = audio_source
+            player.now_playing_channel = ctx.channel
             
-            await ctx.send(f"✅ Now streaming from: **{stream_url}**")
+            title = stream_titles.get(player.stream_url)
+            text = f"🔴 Now streaming: **{stream_label(player.stream_url)}**"
+            update_bus.now_playing(player, ctx.channel, f"{text}\n🎵 {title}" if title else text)
         except Exception as e:
+            audio_source.cleanup()
             await ctx.send(f"❌ Failed to play stream: {str(e)}")
             logging.error(f"Stream playback error: {e}")
             return
@@ -349,14 +3381,15 @@ async def play_icecast_stream(ctx, stream_url):
 # Music control commands
 @bot.command(name='play', help='Play a YouTube video or add to queue')
 async def play(ctx, *, search):
-    global music_queue, default_volume, is_playing_stream
-    
     # Use helper function to safely get voice channel
     voice_channel, error = get_member_voice(ctx)
     if error:
         await ctx.send(error)
         return
     
+    player = players.get(ctx.guild.id)
+    player.mark_command('play')
+    
     # Connect to voice channel if not already connected
     if not ctx.voice_client:
         await voice_channel.connect()
@@ -364,9 +3397,9 @@ async def play(ctx, *, search):
         await ctx.voice_client.move_to(voice_channel)
 
     # Stop stream if currently playing
-    if is_playing_stream and ctx.voice_client.is_playing():
+    if player.is_playing_stream and ctx.voice_client.is_playing():
         ctx.voice_client.stop()
-        is_playing_stream = False
+        player.is_playing_stream = False
         await ctx.send("🔄 Switched from stream to music queue")
 
     async with ctx.typing():
@@ -374,45 +3407,49 @@ async def play(ctx, *, search):
         if 'playlist' in search or 'list=' in search:
             await handle_playlist(ctx, search)
         else:
-            # Single video
-            source = await YTDLSource.create_source(search, volume=default_volume)
-            if source:
-                track_info = {
-                    'type': 'youtube',
-                    'title': source.title,
-                    'url': search,
-                    'duration': source.duration,
-                    'uploader': source.uploader,
-                    'source': source
-                }
+            # Single video: resolve metadata only, play_next creates the source
+            try:
+                info = await resolution_cache.resolve(search, guild_id=ctx.guild.id)
+            except Exception as e:
+                logging.error(f"Error resolving YouTube track: {e}")
+                info = None
+            
+            if info:
+                track = Track.from_info(info, url=search)
                 
-                if ctx.voice_client.is_playing():
-                    music_queue.add_track(track_info)
-                    position = len(music_queue.get_queue_info())
-                    await ctx.send(f"✅ Added to queue (position {position}): **{source.title}**")
+                if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
+                    player.queue.add_track(track)
+                    player.schedule_prefetch()
+                    position = len(player.queue.get_queue_info())
+                    await ctx.send(f"✅ Added to queue (position {position}): **{track.title}**")
                 else:
-                    music_queue.current_track = track_info
-                    
-                    def after_playing(error):
-                        if error:
-                            logging.error(f'Player error: {error}')
-                        asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
-                    
-                    ctx.voice_client.play(source, after=after_playing)
-                    await ctx.send(f"🎵 Now playing: **{source.title}**")
+                    player.queue.add_track(track)
+                    await play_next(ctx)
             else:
                 await ctx.send("❌ Could not find or play that video!")
-
-@bot.command(name='stream', help='Play an Icecast stream')
-async def stream(ctx, url=None):
-    global is_playing_stream
     
+    # Only a command that started playback is measured
+    player.command_started = None
+
+@bot.command(name='stream', help='Play an Icecast stream by name or URL')
+async def stream(ctx, *, url=None):
     # Use helper function to safely get voice channel
     voice_channel, error = get_member_voice(ctx)
     if error:
         await ctx.send(error)
         return
     
+    # Configured streams can be picked by name, e.g. !stream 100 Techno
+    if url and not url.startswith(('http://', 'https://')):
+        name, url = url, find_stream(url)
+        if url is None:
+            names = ", ".join(stream['name'] for stream in configured_streams)
+            await ctx.send(f"❌ Unknown stream **{name}**. Available: {names}")
+            return
+    
+    player = players.get(ctx.guild.id)
+    player.mark_command('stream')
+    
     # Connect to voice channel if not already connected
     if not ctx.voice_client:
         try:
@@ -437,15 +3474,63 @@ async def stream(ctx, url=None):
         await asyncio.sleep(0.5)  # Give it time to stop
     
     # Clear queue when switching to stream
-    if not is_playing_stream:
-        music_queue.clear()
+    if not player.is_playing_stream:
+        player.queue.clear()
     
     await play_icecast_stream(ctx, stream_url)
+    player.command_started = None
+
+@bot.command(name='rewind', help='Rewind the live stream, e.g. !rewind 30 or !rewind 2:00')
+async def rewind(ctx, amount='30'):
+    subscriber = stream_subscriber(ctx.voice_client.source if ctx.voice_client else None)
+    if subscriber is None:
+        await ctx.send("❌ Rewinding only works while a stream is playing!")
+        return
+    try:
+        frames = int(parse_offset(amount) * 50)
+    except (ValueError, OverflowError):
+        await ctx.send("❌ Give seconds or minutes:seconds, e.g. `!rewind 90` or `!rewind 1:30`")
+        return
+    
+    # Relative to what is playing now, so repeated rewinds add up
+    current = subscriber.cursor if subscriber.seek_cursor is None else subscriber.seek_cursor
+    cursor = subscriber.seek(current - frames)
+    message = f"⏪ Now **{format_offset(subscriber.behind_live())}** behind live"
+    if cursor == subscriber.hub.oldest_cursor():
+        message += " (as far back as the stream is kept)"
+    await ctx.send(f"{message}. Use `!live` to catch up.")
+
+@bot.command(name='replay', help='Replay the current stream song from its start')
+async def replay(ctx):
+    subscriber = stream_subscriber(ctx.voice_client.source if ctx.voice_client else None)
+    if subscriber is None:
+        await ctx.send("❌ Replaying only works while a stream is playing!")
+        return
+    
+    current = subscriber.cursor if subscriber.seek_cursor is None else subscriber.seek_cursor
+    mark = subscriber.hub.title_at(current)
+    if mark is None:
+        await ctx.send("❌ The stream hasn't announced a song yet, try `!rewind` instead.")
+        return
+    
+    start, title = mark
+    cursor = subscriber.seek(start)
+    message = f"🔁 Replaying **{title}**"
+    if cursor > start:
+        message += " from as far back as the stream is kept"
+    await ctx.send(f"{message}, {format_offset(subscriber.behind_live())} behind live. Use `!live` to catch up.")
+
+@bot.command(name='live', help='Return to the live stream after !rewind or !replay')
+async def go_live(ctx):
+    subscriber = stream_subscriber(ctx.voice_client.source if ctx.voice_client else None)
+    if subscriber is None:
+        await ctx.send("❌ No stream is playing!")
+        return
+    subscriber.seek(subscriber.hub.start_cursor())
+    await ctx.send(f"🔴 Back to live: **{stream_label(subscriber.url)}**")
 
 @bot.command(name='volume', help='Change the volume (0-100)')
 async def set_volume(ctx, vol: int):
-    global default_volume
-    
     if not ctx.voice_client:
         await ctx.send("Not connected to a voice channel!")
         return
@@ -454,18 +3539,22 @@ async def set_volume(ctx, vol: int):
         await ctx.send("Volume must be between 0 and 100!")
         return
 
-    # Update default volume for future tracks
-    default_volume = vol / 100
+    # Update this guild's volume for future tracks
+    player = players.get(ctx.guild.id)
+    player.volume = vol / 100
     
     # Update current playing source volume if it exists and supports volume control
     if ctx.voice_client.source:
-        if hasattr(ctx.voice_client.source, 'volume'):
-            ctx.voice_client.source.volume = default_volume
-        elif music_queue.current_track and music_queue.current_track.get('source'):
+        # Tracks are wrapped in a BufferedSource, look at the ffmpeg source inside
+        if isinstance(getattr(ctx.voice_client.source, 'source', ctx.voice_client.source), YTDLOpusSource):
+            # Opus tracks bake the volume into ffmpeg's filter graph
+            await ctx.send(f"Volume set to {vol}%, applies from the next track")
+            return
+        elif hasattr(ctx.voice_client.source, 'volume'):
+            ctx.voice_client.source.volume = player.volume
+        elif player.current_source and hasattr(player.current_source, 'volume'):
             # Update the stored source volume
-            source = music_queue.current_track['source']
-            if hasattr(source, 'volume'):
-                source.volume = default_volume
+            player.current_source.volume = player.volume
     
     await ctx.send(f"Volume set to {vol}%")
 
@@ -488,7 +3577,12 @@ async def resume(ctx):
 @bot.command(name='skip', help='Skip the current track')
 async def skip(ctx):
     if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.stop()
+        player = players.get(ctx.guild.id)
+        if player.mixer and ctx.voice_client.source is player.mixer:
+            # Fade the current track out while the next one is started
+            player.mixer.skip()
+        else:
+            ctx.voice_client.stop()
         await ctx.send("Skipped ⏭️")
     else:
         await ctx.send("Nothing is currently playing!")
@@ -496,7 +3590,9 @@ async def skip(ctx):
 @bot.command(name='queue', help='Show the current queue')
 async def show_queue(ctx):
     try:
-        global music_queue, is_playing_stream
+        player = players.get(ctx.guild.id)
+        music_queue = player.queue
+        is_playing_stream = player.is_playing_stream
         
         # Debug info
         logging.info(f"Queue command called - is_playing_stream: {is_playing_stream}")
@@ -525,12 +3621,12 @@ async def show_queue(ctx):
         message = "🎵 **Music Queue**\n\n"
         
         if current:
-            message += f"**Now Playing:**\n🎵 {current['title']}\n\n"
+            message += f"**Now Playing:**\n🎵 {current.title}\n\n"
         
         if queue_list:
             message += f"**Up Next ({len(queue_list)} tracks):**\n"
             for i, track in enumerate(queue_list[:10], 1):
-                message += f"`{i}.` {track['title']}\n"
+                message += f"`{i}.` {track.title}\n"
             
             if len(queue_list) > 10:
                 message += f"... and {len(queue_list) - 10} more tracks\n"
@@ -543,19 +3639,48 @@ async def show_queue(ctx):
 
 @bot.command(name='clear', help='Clear the music queue')
 async def clear_queue(ctx):
-    global music_queue
-    music_queue.clear()
+    players.get(ctx.guild.id).queue.clear()
     await ctx.send("Queue cleared! 🗑️")
 
+@bot.command(name='remove', help='Remove a track from the queue by position')
+async def remove_track(ctx, position: int):
+    music_queue = players.get(ctx.guild.id).queue
+    if not 1 <= position <= len(music_queue.queue):
+        await ctx.send(f"Position must be between 1 and {len(music_queue.queue)}!")
+        return
+    track = music_queue.remove(position - 1)
+    await ctx.send(f"🗑️ Removed: **{track.title}**")
+
+@bot.command(name='move', help='Move a track to a new position in the queue')
+async def move_track(ctx, from_position: int, to_position: int):
+    player = players.get(ctx.guild.id)
+    queue_size = len(player.queue.queue)
+    if not (1 <= from_position <= queue_size and 1 <= to_position <= queue_size):
+        await ctx.send(f"Positions must be between 1 and {queue_size}!")
+        return
+    track = player.queue.move(from_position - 1, to_position - 1)
+    player.schedule_prefetch()
+    await ctx.send(f"↕️ Moved **{track.title}** to position {to_position}")
+
+@bot.command(name='shuffle', help='Shuffle the queue and toggle shuffle mode')
+async def shuffle_queue(ctx):
+    player = players.get(ctx.guild.id)
+    player.queue.shuffle_mode = not player.queue.shuffle_mode
+    if player.queue.shuffle_mode:
+        player.queue.shuffle()
+        player.schedule_prefetch()
+        await ctx.send("🔀 Shuffle enabled, queue shuffled!")
+    else:
+        await ctx.send("Shuffle disabled")
+
 @bot.command(name='stop', help='Stop playing and disconnect')
 async def stop(ctx):
-    global music_queue, is_playing_stream
-    
     if ctx.voice_client:
         ctx.voice_client.stop()
         await ctx.voice_client.disconnect()
-        music_queue.clear()
-        is_playing_stream = False
+        # Nothing left to keep for this guild, free its player right away
+        players.remove(ctx.guild.id)
+        update_bus.request_presence()
         await ctx.send("Stopped and disconnected! 👋")
     else:
         await ctx.send("Not connected to a voice channel!")
@@ -563,7 +3688,9 @@ async def stop(ctx):
 @bot.command(name='nowplaying', aliases=['np'], help='Show current track info')
 async def now_playing_cmd(ctx):
     try:
-        global is_playing_stream, music_queue
+        player = players.get(ctx.guild.id)
+        music_queue = player.queue
+        is_playing_stream = player.is_playing_stream
         
         # Debug logging
         logging.info(f"Now playing command called")
@@ -582,20 +3709,32 @@ async def now_playing_cmd(ctx):
             return
         
         if is_playing_stream:
-            await ctx.send("🔴 **Now Streaming**\nIcecast stream is currently playing.")
+            title = stream_titles.get(player.stream_url)
+            subscriber = stream_subscriber(ctx.voice_client.source)
+            if subscriber is not None and subscriber.behind_live() >= 1:
+                mark = subscriber.hub.title_at(subscriber.cursor)
+                behind = format_offset(subscriber.behind_live())
+                if mark:
+                    await ctx.send(f"⏪ **Streaming {behind} behind live**\n**Title:** {mark[1]}")
+                else:
+                    await ctx.send(f"⏪ **Streaming {behind} behind live**")
+            elif title:
+                await ctx.send(f"🔴 **Now Streaming**\n**Title:** {title}")
+            else:
+                await ctx.send("🔴 **Now Streaming**\nIcecast stream is currently playing.")
             return
         
         if music_queue.current_track:
             track = music_queue.current_track
-            title = track.get('title', 'Unknown Track')
-            uploader = track.get('uploader', 'Unknown Artist')
+            title = track.title or 'Unknown Track'
+            uploader = track.uploader or 'Unknown Artist'
             
             message = f"🎵 **Now Playing**\n\n"
             message += f"**Title:** {title}\n"
             message += f"**Artist:** {uploader}\n"
             
-            if track.get('duration'):
-                mins, secs = divmod(track['duration'], 60)
+            if track.duration:
+                mins, secs = divmod(int(track.duration), 60)
                 message += f"**Duration:** {mins}:{secs:02d}\n"
             
             queue_size = len(music_queue.get_queue_info())
@@ -613,7 +3752,9 @@ async def now_playing_cmd(ctx):
 @bot.command(name='debug', help='Show debug information')
 async def debug_info(ctx):
     try:
-        global music_queue, is_playing_stream, current_source
+        player = players.get(ctx.guild.id)
+        music_queue = player.queue
+        is_playing_stream = player.is_playing_stream
         
         message = "🔧 **Debug Information**\n\n"
         
@@ -631,7 +3772,7 @@ async def debug_info(ctx):
         # Queue info  
         message += f"📋 **Current Track:** {music_queue.current_track is not None}\n"
         if music_queue.current_track:
-            message += f"   - Title: {music_queue.current_track.get('title', 'N/A')}\n"
+            message += f"   - Title: {music_queue.current_track.title or 'N/A'}\n"
         
         queue_list = music_queue.get_queue_info()
         message += f"📝 **Queue Size:** {len(queue_list)}\n"
@@ -640,7 +3781,27 @@ async def debug_info(ctx):
         if queue_list:
             message += "📋 **Queue Preview:**\n"
             for i, track in enumerate(queue_list[:3], 1):
-                message += f"   {i}. {track.get('title', 'Unknown')}\n"
+                message += f"   {i}. {track.title or 'Unknown'}\n"
+        
+        message += f"🏠 **Guild Players:** {len(players)}\n"
+        message += f"🗄️ **Resolve Cache:** {resolution_cache.stats()}\n"
+        message += f"💾 **Audio Cache:** {audio_cache.stats()}\n"
+        message += f"🔊 **Loudness:** {loudness.stats()}\n"
+        message += f"⚙️ **Extraction Pool:** {extraction_pool.stats()}\n"
+        message += f"🧩 **Audio Workers:** {audio_workers.stats()}\n"
+        message += f"🚦 **Admission:** {resource_governor.stats(ctx.guild.id)}\n"
+        message += f"⏱️ **Event Loop:** {loop_watchdog.stats()}\n"
+        source = ctx.voice_client.source if ctx.voice_client else None
+        if isinstance(source, PCMMixer):
+            source = source.current
+        if hasattr(source, 'stats'):
+            message += f"🛟 **Playback Buffer:** {source.stats()}\n"
+        message += f"📻 **Broadcasts:** {broadcast_hubs.stats()}\n"
+        message += f"📣 **Status Updates:** {update_bus.stats()}\n"
+        message += f"👂 **Watched Channels:** {voice_watcher.stats()}\n"
+        message += f"📡 **Stream Health:** {stream_health.probes} probes, {stream_health.skipped} skipped\n"
+        for s in configured_streams:
+            message += f"   - {s['name']}: {stream_health.describe(s['url'])}\n"
         
         await ctx.send(message)
         
@@ -655,90 +3816,272 @@ async def test_command(ctx):
 async def toggle_auto_join(ctx):
     global auto_join_enabled
     auto_join_enabled = not auto_join_enabled
+    if auto_join_enabled:
+        for presence in voice_watcher.channels.values():
+            voice_watcher.schedule(presence, delay=0)
     status = "enabled" if auto_join_enabled else "disabled"
     await ctx.send(f"Auto-rejoin {status}")
 
+# Snapshots of player state, restored after a restart
+class PlaybackContext:
+    # Stand-in for commands.Context when playback resumes without a command
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        if self.channel:
+            return await self.channel.send(*args, **kwargs)
+
+def collect_snapshots():
+    rows = []
+    for player in list(players.players.values()):
+        guild = bot.get_guild(player.guild_id)
+        voice_client = guild.voice_client if guild else None
+        if voice_client is None or voice_client.channel is None:
+            continue
+        if player.is_playing_stream:
+            tracks, position = [], 0
+        elif player.queue.current_track:
+            tracks = [player.queue.current_track] + list(player.queue.queue)
+            position = player.position()
+        else:
+            continue
+        text_channel = player.now_playing_channel
+        rows.append((
+            player.guild_id,
+            voice_client.channel.id,
+            text_channel.id if text_channel else None,
+            player.volume,
+            player.stream_url if player.is_playing_stream else None,
+            position,
+            json.dumps([track.to_tuple() for track in tracks], separators=(',', ':')),
+            time.time(),
+        ))
+    return rows
+
+async def snapshot_task():
+    while True:
+        await asyncio.sleep(config.get("snapshot_interval", 30))
+        try:
+            rows = collect_snapshots()
+            await asyncio.to_thread(state_store.save_snapshots, rows)
+        except Exception as e:
+            logging.error(f"Error saving player snapshot: {e}")
+
+snapshots_restored = False
+
+async def restore_snapshots():
+    global snapshots_restored
+    if snapshots_restored:
+        return
+    snapshots_restored = True
+    
+    try:
+        rows = await asyncio.to_thread(state_store.load_snapshots)
+    except Exception as e:
+        logging.error(f"Error loading player snapshot: {e}")
+        return
+    await asyncio.gather(*(resume_player(*row) for row in rows))
+
+async def resume_player(guild_id, voice_channel_id, text_channel_id, volume, stream_url, position, tracks):
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return
+    player = players.get(guild_id)
+    player.volume = volume
+    tracks = [Track(*fields) for fields in json.loads(tracks)]
+    text_channel = guild.get_channel(text_channel_id) if text_channel_id else None
+    player.now_playing_channel = text_channel
+    
+    channel = guild.get_channel(voice_channel_id)
+    if channel is None or not any(not member.bot for member in channel.members):
+        # Nobody to play to, keep the queue for the next !play
+        player.queue.queue.extend(tracks)
+        return
+    
+    try:
+        voice_client = guild.voice_client or await channel.connect()
+        if stream_url:
+            await start_stream(player, voice_client, stream_url)
+        elif tracks:
+            # Only the head track is resolved now, the rest goes through the prefetcher
+            player.queue.queue.extend(tracks)
+            player.pending_offset = position
+            await play_next(PlaybackContext(guild, text_channel))
+        logging.info(f"Restored playback for guild {guild_id} ({len(tracks)} tracks)")
+    except Exception as e:
+        logging.error(f"Error restoring playback for guild {guild_id}: {e}")
+
+background_tasks_started = False
+
 # Event handlers
 @bot.event
 async def on_ready():
+    global background_tasks_started
     logging.info(f'{bot.user} is ready!')
-    # Start status update task
-    bot.loop.create_task(update_status_task())
+    # Start presence/now-playing updates, status polling and idle player eviction
+    update_bus.start()
+    update_bus.request_presence()
+    # on_ready fires again after every gateway reconnect, the loops must only run once
+    if not background_tasks_started:
+        background_tasks_started = True
+        bot.loop.create_task(status_poll_task())
+        bot.loop.create_task(player_eviction_task())
+        bot.loop.create_task(stream_health.refresh_configured())
+        bot.loop.create_task(snapshot_task())
+    # Resume saved playback before auto-join so both don't race to connect
+    await restore_snapshots()
     await check_and_join_voice_channel()
 
+class ChannelPresence:
+    __slots__ = ('channel_id', 'guild_id', 'listeners', 'state', 'timer', 'busy', 'dirty')
+
+    def __init__(self, channel):
+        self.channel_id = channel.id
+        self.guild_id = channel.guild.id
+        self.listeners = sum(1 for member in channel.members if not member.bot)
+        self.state = 'connected' if channel.guild.voice_client else 'idle'
+        self.timer = None
+        self.busy = False
+        self.dirty = False
+
+class VoiceWatcher:
+    def __init__(self, debounce=1.0):
+        self.debounce = debounce
+        self.channels = {}
+
+    def watch(self, channel):
+        presence = ChannelPresence(channel)
+        self.channels[channel.id] = presence
+        return presence
+
+    def on_voice_state(self, member, before, after):
+        # O(1) per event: only membership changes on watched channels are counted
+        if member.bot:
+            return
+        before_id = before.channel.id if before.channel else None
+        after_id = after.channel.id if after.channel else None
+        if before_id == after_id:
+            return
+        if before_id in self.channels:
+            presence = self.channels[before_id]
+            presence.listeners = max(presence.listeners - 1, 0)
+            self.schedule(presence)
+        if after_id in self.channels:
+            presence = self.channels[after_id]
+            presence.listeners += 1
+            self.schedule(presence)
+
+    def schedule(self, presence, delay=None):
+        # Bursts of joins/leaves collapse into one reconcile per channel
+        if presence.timer:
+            presence.timer.cancel()
+        loop = asyncio.get_running_loop()
+        presence.timer = loop.call_later(self.debounce if delay is None else delay,
+                                         lambda: loop.create_task(self.reconcile(presence)))
+
+    async def reconcile(self, presence):
+        # Single flight: a running connect/disconnect picks up newer changes when it finishes
+        if presence.busy:
+            presence.dirty = True
+            return
+        presence.busy = True
+        try:
+            presence.dirty = True
+            while presence.dirty:
+                presence.dirty = False
+                channel = bot.get_channel(presence.channel_id)
+                if channel is None:
+                    return
+                voice_client = channel.guild.voice_client
+                connected = voice_client is not None and voice_client.channel == channel
+                # !autorejoin only gates joining; an empty channel is always left
+                if auto_join_enabled and presence.listeners > 0 and voice_client is None:
+                    presence.state = 'connecting'
+                    await handle_user_joined(channel)
+                elif presence.listeners == 0 and connected:
+                    presence.state = 'disconnecting'
+                    await handle_user_left(channel)
+                voice_client = channel.guild.voice_client
+                presence.state = 'connected' if voice_client and voice_client.channel == channel else 'idle'
+        except Exception as e:
+            logging.error(f"Error handling voice channel {presence.channel_id}: {e}")
+            presence.state = 'idle'
+        finally:
+            presence.busy = False
+
+    def stats(self):
+        return ", ".join(f"{p.channel_id}: {p.listeners} listener(s), {p.state}" for p in self.channels.values()) or "none"
+
+voice_watcher = VoiceWatcher(debounce=config.get("voice_debounce", 1.0))
+
 async def check_and_join_voice_channel():
-    global auto_join_enabled
-    
-    if not auto_join_enabled:
-        return
-        
-    guild = discord.utils.get(bot.guilds, id=int(config["guild_id"]))
+    # Resolve the configured IDs once; voice state events are then matched by channel ID
+    guild = bot.get_guild(int(config["guild_id"]))
     if guild is None:
         logging.error('Server not found!')
         return
 
-    channel = discord.utils.get(guild.voice_channels, id=int(config["voice_channel_id"]))
+    channel = guild.get_channel(int(config["voice_channel_id"]))
     if channel is None:
         logging.error('Voice channel not found!')
         return
 
-    if len(channel.members) > 0:
-        await handle_user_joined(channel)
+    presence = voice_watcher.watch(channel)
+    if auto_join_enabled and presence.listeners > 0:
+        voice_watcher.schedule(presence, delay=0)
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    global auto_join_enabled
-    
-    if not auto_join_enabled:
-        return
-        
-    guild = discord.utils.get(bot.guilds, id=int(config["guild_id"]))
-    if guild is None:
-        return
+    # Counts stay current even while auto-join is off; reconcile checks the toggle
+    voice_watcher.on_voice_state(member, before, after)
 
-    channel = discord.utils.get(guild.voice_channels, id=int(config["voice_channel_id"]))
-    if channel is None:
-        return
-
-    if after.channel == channel:
-        await handle_user_joined(channel)
-    elif before.channel == channel:
-        await handle_user_left(channel)
+async def start_stream(player, voice_client, stream_url):
+    permit = await admit_stream(stream_url, player.volume)
+    try:
+        audio_source = open_stream(player, stream_url, permit=permit)
+    except Exception:
+        if permit:
+            permit.release()
+        raise
+    voice_client.play(audio_source)
+    player.is_playing_stream = True
+    player.stream_url = stream_url
+    player.current_source = audio_source
+    update_bus.request_presence()
 
 async def handle_user_joined(channel):
-    global default_volume, is_playing_stream, current_source
-    
-    non_bot_members = [member for member in channel.members if not member.bot]
-    if len(non_bot_members) == 0:
-        return
-
-    # If the bot is not already in the channel, join it and start playing the stream
-    if not any(voice_client.channel == channel for voice_client in bot.voice_clients):
+    # If the bot is not already in a voice channel here, join it and start playing the stream
+    if channel.guild.voice_client is None:
         voice_client = await channel.connect()
         await asyncio.sleep(1)  # Small delay to ensure connection is stable
         
         # Start playing the default Icecast stream
+        if not broadcast_hubs.is_live(config["icecast_url"]):
+            health = await stream_health.probe(config["icecast_url"], priority=PRIORITY_PLAYBACK)
+            if not health.ok:
+                logging.error(f"Default stream unavailable: {health.error or health.status}")
+                return
+        
         try:
-            audio_source = FFmpegPCMAudio(config["icecast_url"], options="-loglevel error")
-            audio_source = PCMVolumeTransformer(audio_source, volume=default_volume)
-            voice_client.play(audio_source)
-            is_playing_stream = True
-            current_source = audio_source
+            await start_stream(players.get(channel.guild.id), voice_client, config["icecast_url"])
         except Exception as e:
             logging.error(f"Error starting stream: {e}")
 
 async def handle_user_left(channel):
-    global is_playing_stream
-    
-    non_bot_members = [member for member in channel.members if not member.bot]
-    if len(non_bot_members) > 0:
-        return
-
-    # If the bot is the only one left in the channel, disconnect
-    for voice_client in bot.voice_clients:
-        if voice_client.channel == channel:
-            await voice_client.disconnect()
-            is_playing_stream = False
+    # The bot is the only one left in the channel, disconnect
+    voice_client = channel.guild.voice_client
+    if voice_client and voice_client.channel == channel:
+        await voice_client.disconnect()
+        player = players.peek(channel.guild.id)
+        if player:
+            player.is_playing_stream = False
+        update_bus.request_presence()
 
 if __name__ == "__main__":
     bot.run(config["discord_bot_key"])